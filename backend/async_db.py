@@ -0,0 +1,50 @@
+"""
+Async facade over db.py for async handlers.
+Calls run on a small pool of DB threads, so a slow query or commit waits
+there instead of blocking the event loop:
+
+    user = await async_db.get_session(session_id)
+
+Writes of a whole list (BULK_WRITES) get a thread of their own, so a long
+upload never holds up the quick queries of other requests.
+"""
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+
+# Each thread has its own db.py connection; in WAL mode their reads run
+# alongside a write instead of waiting for it
+DB_THREADS = int(os.getenv("ASYNC_DB_THREADS", "4"))
+BULK_WRITES = {"save_csv", "append_csv", "create_send_job"}
+
+_executor = ThreadPoolExecutor(max_workers=DB_THREADS, thread_name_prefix="db")
+# One at a time is enough: SQLite only lets one of them write at once anyway
+_bulk_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-bulk")
+
+
+async def _run_on(executor, fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(fn, *args, **kwargs))
+
+
+async def run(fn, *args, **kwargs):
+    """Run any blocking call (db or shared_state) on a DB thread"""
+    return await _run_on(_executor, fn, *args, **kwargs)
+
+
+def __getattr__(name):
+    """async_db.<name> is an awaitable version of db.<name>"""
+    fn = getattr(db, name, None)
+    if not callable(fn) or name.startswith("_"):
+        raise AttributeError(f"module 'async_db' has no attribute '{name}'")
+    executor = _bulk_executor if name in BULK_WRITES else _executor
+
+    @functools.wraps(fn)
+    async def call(*args, **kwargs):
+        return await _run_on(executor, fn, *args, **kwargs)
+
+    globals()[name] = call
+    return call
@@ -0,0 +1,128 @@
+"""Compression and row indexing helpers for stored CSVs"""
+import csv
+import hashlib
+import io
+import json
+import zlib
+
+from recipients import read_csv
+
+CSV_CHUNK_SIZE = 64 * 1024
+
+
+def compress_csv(content):
+    """gzip-compress CSV text for storage"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    return compressor.compress(content.encode("utf-8")) + compressor.flush()
+
+
+def decompress_chunks(chunks):
+    """Yield decompressed bytes from a gzip stream of one or more members"""
+    decompressor = zlib.decompressobj(31)
+    for chunk in chunks:
+        while chunk:
+            yield decompressor.decompress(chunk)
+            # A new gzip member starts where the previous one ended
+            chunk = decompressor.unused_data
+            if decompressor.eof:
+                yield decompressor.flush()
+                decompressor = zlib.decompressobj(31)
+    yield decompressor.flush()
+
+
+def csv_text(content, content_gz):
+    """Full CSV text from either the compressed or the legacy TEXT column"""
+    if content_gz is not None:
+        return b"".join(decompress_chunks([content_gz])).decode("utf-8")
+    return content or ""
+
+
+def content_hash(data):
+    """SHA-256 of an uploaded file's bytes, used to spot re-uploads"""
+    return hashlib.sha256(data).hexdigest()
+
+
+def row_hash(values):
+    """Short hash of a row's values, used to skip duplicate rows on append"""
+    return hashlib.blake2b(json.dumps(values).encode("utf-8"), digest_size=12).hexdigest()
+
+
+def index_csv_rows(conn, csv_id, content):
+    """Split CSV text into csv_rows; returns the number of data rows"""
+    headers, rows = read_csv(content)
+    count = [0]
+
+    def row_params():
+        for row_index, values in rows:
+            count[0] += 1
+            yield (csv_id, row_index, json.dumps(values), row_hash(values))
+
+    conn.executemany(
+        "INSERT OR REPLACE INTO csv_rows (csv_id, row_index, data, row_hash) VALUES (?, ?, ?, ?)",
+        row_params(),
+    )
+    conn.execute(
+        "UPDATE csvs SET headers=?, row_count=? WHERE id=?",
+        (json.dumps(headers), count[0], csv_id),
+    )
+    return count[0]
+
+
+def append_csv_rows(conn, csv_id, headers, content):
+    """
+    Add rows from CSV text that the stored list doesn't already contain.
+    Columns are matched by header name. Returns the number of rows added,
+    or None if the headers don't match the stored list.
+    """
+    new_headers, rows = read_csv(content)
+    if set(new_headers) != set(headers):
+        return None
+    order = [new_headers.index(h) for h in headers]
+
+    next_index = conn.execute(
+        "SELECT COALESCE(MAX(row_index), -1) + 1 FROM csv_rows WHERE csv_id=?", (csv_id,)
+    ).fetchone()[0]
+
+    added = io.StringIO()
+    writer = csv.writer(added, lineterminator="\n")
+    count = 0
+    for _, values in rows:
+        values = [values[i] if i < len(values) else "" for i in order]
+        digest = row_hash(values)
+        # Also catches duplicates within the appended file itself
+        if conn.execute(
+            "SELECT 1 FROM csv_rows WHERE csv_id=? AND row_hash=? LIMIT 1", (csv_id, digest)
+        ).fetchone():
+            continue
+        conn.execute(
+            "INSERT INTO csv_rows (csv_id, row_index, data, row_hash) VALUES (?, ?, ?, ?)",
+            (csv_id, next_index + count, json.dumps(values), digest),
+        )
+        writer.writerow(values)
+        count += 1
+
+    if count:
+        added_text = added.getvalue()
+        # The new rows must start on their own line even if the upload had no
+        # trailing newline
+        if not stored_ends_with_newline(conn, csv_id):
+            added_text = "\n" + added_text
+        # gzip members concatenate, so the stored file grows without being rewritten
+        # in Python; it no longer matches any uploaded file's hash. || returns
+        # TEXT, so the result is cast back to a BLOB
+        conn.execute("""
+            UPDATE csvs SET content_gz = CAST(content_gz || ? AS BLOB), content_hash = NULL,
+                            row_count = row_count + ?
+            WHERE id=?
+        """, (compress_csv(added_text), count, csv_id))
+    return count
+
+
+def stored_ends_with_newline(conn, csv_id):
+    """Whether a stored (compressed) CSV ends with a newline; decompressed chunk by chunk"""
+    last = b""
+    with conn.blobopen("csvs", "content_gz", csv_id, readonly=True) as blob:
+        for chunk in decompress_chunks(iter(lambda: blob.read(CSV_CHUNK_SIZE), b"")):
+            if chunk:
+                last = chunk
+    return not last or last.endswith(b"\n")
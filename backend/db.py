@@ -1,8 +1,20 @@
 import sqlite3
 import json
 import uuid
+import hashlib
+import threading
+import time
 from datetime import datetime, timedelta
 
+from csv_store import (
+    CSV_CHUNK_SIZE,
+    compress_csv,
+    decompress_chunks,
+    index_csv_rows,
+    append_csv_rows,
+)
+from migrations import DB_PATH, DB_BUSY_TIMEOUT
+
 # Import crypto utilities with fallback
 try:
     from crypto_utils import encrypt_token, decrypt_token
@@ -13,79 +25,36 @@ except ImportError:
     def decrypt_token(token):
         return token
 
-conn = sqlite3.connect("database.db", check_same_thread=False)
-cur = conn.cursor()
-
-cur.execute("""
-CREATE TABLE IF NOT EXISTS users (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    google_id TEXT UNIQUE,
-    email TEXT,
-    name TEXT,
-    gmail_token TEXT,
-    gmail_refresh_token TEXT
-)
-""")
+# Schema is managed by migrations.py and applied once at startup.
+# Every thread gets its own connection, so one thread's commit (or rollback)
+# never takes in another thread's half-finished transaction.
+# The database is in WAL mode (see migrations.connect): reads don't wait for
+# writes, and writers from other threads or processes are waited for up to
+# DB_BUSY_TIMEOUT seconds.
+_local = threading.local()
 
-# Add missing columns to users table if they don't exist
-try:
-    cur.execute("ALTER TABLE users ADD COLUMN gmail_token TEXT")
-except Exception:
-    pass  # Column already exists
 
-try:
-    cur.execute("ALTER TABLE users ADD COLUMN gmail_refresh_token TEXT")
-except Exception:
-    pass  # Column already exists
-
-cur.execute("""
-CREATE TABLE IF NOT EXISTS sessions (
-    session_id TEXT PRIMARY KEY,
-    user_id INTEGER,
-    data TEXT,
-    expires_at TIMESTAMP,
-    FOREIGN KEY(user_id) REFERENCES users(id)
-)
-""")
-
-cur.execute("""
-CREATE TABLE IF NOT EXISTS gmail_accounts (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER,
-    gmail_id TEXT UNIQUE,
-    email TEXT,
-    name TEXT,
-    access_token TEXT,
-    refresh_token TEXT,
-    added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    FOREIGN KEY(user_id) REFERENCES users(id)
-)
-""")
-
-cur.execute("""
-CREATE TABLE IF NOT EXISTS csvs (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER,
-    filename TEXT,
-    content TEXT,
-    row_count INTEGER,
-    uploaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-)
-""")
-
-cur.execute("""
-CREATE TABLE IF NOT EXISTS emails_sent (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER,
-    recipient_email TEXT,
-    subject TEXT,
-    sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-)
-""")
+def _connect():
+    """The calling thread's connection"""
+    connection = getattr(_local, "conn", None)
+    if connection is None:
+        connection = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT)
+        connection.execute("PRAGMA synchronous=NORMAL")
+        _local.conn = connection
+    return connection
+
+
+class _ThreadConnection:
+    """Stands in for a sqlite3 connection; each thread uses its own"""
+
+    def __getattr__(self, name):
+        return getattr(_connect(), name)
 
-conn.commit()
+
+conn = _ThreadConnection()
 
 def get_or_create_user(google_id, email, name):
+    cur = conn.cursor()
     cur.execute("SELECT id FROM users WHERE google_id=?", (google_id,))
     row = cur.fetchone()
     if row:
@@ -98,37 +67,182 @@ def get_or_create_user(google_id, email, name):
     conn.commit()
     return cur.lastrowid
 
-def save_csv(user_id, filename, content):
-    """Save CSV file and return the CSV ID"""
-    rows = len(content.strip().split('\n')) - 1  # Subtract header row
+def save_csv(user_id, filename, content, content_hash=None):
+    """Save CSV file, index its rows and return the CSV ID"""
+    cur = conn.cursor()
     cur.execute("""
-        INSERT INTO csvs (user_id, filename, content, row_count)
-        VALUES (?, ?, ?, ?)
-    """, (user_id, filename, content, rows))
+        INSERT INTO csvs (user_id, filename, content_gz, content_hash, row_count)
+        VALUES (?, ?, ?, ?, 0)
+    """, (user_id, filename, compress_csv(content), content_hash))
+    csv_id = cur.lastrowid
+    index_csv_rows(conn, csv_id, content)
     conn.commit()
-    return cur.lastrowid
+    return csv_id
+
+def find_csv_by_hash(user_id, content_hash):
+    """ID of a user's CSV with identical content, or None"""
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT id FROM csvs WHERE user_id=? AND content_hash=? ORDER BY id DESC LIMIT 1
+    """, (user_id, content_hash))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+def append_csv(csv_id, user_id, content):
+    """
+    Merge new rows into a stored CSV, skipping rows it already has.
+    Returns the number of rows added, or None if the CSV isn't found or the
+    headers don't match.
+    """
+    info = get_csv_info(csv_id, user_id)
+    if not info:
+        return None
+    added = append_csv_rows(conn, csv_id, info[0], content)
+    conn.commit()
+    return added
 
 def get_csvs(user_id):
     """Get all CSVs for a user"""
+    cur = conn.cursor()
     cur.execute("""
         SELECT id, filename, uploaded_at, row_count 
         FROM csvs WHERE user_id=? ORDER BY uploaded_at DESC
     """, (user_id,))
     return cur.fetchall()
 
-def get_csv_content(csv_id, user_id):
-    """Get CSV content for download"""
-    cur.execute("SELECT content FROM csvs WHERE id=? AND user_id=?", (csv_id, user_id))
+def iter_csv_content(csv_id, chunk_size=CSV_CHUNK_SIZE):
+    """
+    Stream a CSV's bytes, decompressing as the blob is read incrementally.
+    No lock is held between chunks. Ownership must be checked by the caller
+    (see get_csv_info).
+    """
+    row = conn.execute(
+        "SELECT content_gz IS NOT NULL, content FROM csvs WHERE id=?", (csv_id,)
+    ).fetchone()
+    if not row:
+        return
+    if not row[0]:
+        # Legacy uncompressed row
+        data = (row[1] or "").encode("utf-8")
+        for start in range(0, len(data), chunk_size):
+            yield data[start:start + chunk_size]
+        return
+
+    offset = 0
+
+    def read_chunk():
+        nonlocal offset
+        # An open blob handle holds a read lock, so it is opened per chunk
+        # rather than for the whole (client-paced) download
+        with conn.blobopen("csvs", "content_gz", csv_id, readonly=True) as blob:
+            blob.seek(offset)
+            chunk = blob.read(chunk_size)
+        offset += len(chunk)
+        return chunk
+
+    for chunk in decompress_chunks(iter(read_chunk, b"")):
+        if chunk:
+            yield chunk
+
+def get_csv_info(csv_id, user_id):
+    """Get (headers, row_count) for a CSV, or None if it isn't the user's"""
+    cur = conn.cursor()
+    cur.execute("SELECT headers, row_count FROM csvs WHERE id=? AND user_id=?", (csv_id, user_id))
     row = cur.fetchone()
-    return row[0] if row else None
+    if not row:
+        return None
+    return tuple(json.loads(row[0] or "[]")), row[1]
+
+def get_csv_rows(csv_id, after=-1, limit=50):
+    """Get a page of (row_index, values) rows after a row index (keyset pagination)"""
+    rows = conn.execute("""
+        SELECT row_index, data FROM csv_rows
+        WHERE csv_id=? AND row_index>? ORDER BY row_index LIMIT ?
+    """, (csv_id, after, limit)).fetchall()
+    return [(row_index, json.loads(data)) for row_index, data in rows]
+
+def get_csv_row(csv_id, row_index):
+    """Get the values of a single CSV row"""
+    row = conn.execute(
+        "SELECT data FROM csv_rows WHERE csv_id=? AND row_index=?", (csv_id, row_index)
+    ).fetchone()
+    return json.loads(row[0]) if row else None
+
+def iter_csv_column_batches(csv_id, positions, last_row_index=None, batch_size=20000):
+    """
+    Stream some columns (by position) of a CSV's rows, up to last_row_index,
+    as (row_indexes, [values per position]) batches. Cells are picked out by
+    json_extract, so the other columns are never decoded, and each batch comes
+    back as one JSON array per column rather than a tuple per row, which is
+    much faster for bulk loads. Missing cells (short rows) are None.
+    """
+    cells = "".join(", json_group_array(json_extract(data, ?))" for _ in positions)
+    paths = [f"$[{int(position)}]" for position in positions]
+    if last_row_index is None:
+        last_row_index = float("inf")
+    after = -1
+    while True:
+        row = conn.execute(f"""
+            SELECT MAX(row_index), json_group_array(row_index){cells}
+            FROM (
+                SELECT row_index, data FROM csv_rows
+                WHERE csv_id=? AND row_index>? AND row_index<=? ORDER BY row_index LIMIT ?
+            )
+        """, paths + [csv_id, after, last_row_index, batch_size]).fetchone()
+        if row[0] is None:
+            return
+        row_indexes, *columns = (json.loads(values) for values in row[1:])
+        yield row_indexes, columns
+        after = row[0]
 
 def count_total_emails_sent(user_id):
     """Count total emails sent by user"""
+    cur = conn.cursor()
     cur.execute("SELECT COUNT(*) FROM emails_sent WHERE user_id=?", (user_id,))
     return cur.fetchone()[0]
 
+def iter_sent_history(user_id, since=None, until=None, job_id=None, account_id=None, batch_size=1000):
+    """
+    Stream a user's sent emails in (sent_at, id) order, one page per query:
+    (id, sent_at, recipient_email, subject, job_id, account_id, sender_email,
+    message_id, thread_id, replied_at, bounced_at). since is inclusive,
+    until exclusive. Each page starts after the last row of the previous one,
+    so deep pages cost the same as the first.
+    """
+    clauses = ["e.user_id=?"]
+    params = [user_id]
+    if since:
+        clauses.append("e.sent_at >= ?")
+        params.append(since)
+    if until:
+        clauses.append("e.sent_at < ?")
+        params.append(until)
+    if job_id:
+        clauses.append("e.job_id=?")
+        params.append(job_id)
+    if account_id:
+        clauses.append("e.account_id=?")
+        params.append(account_id)
+    where = " AND ".join(clauses)
+
+    after = None
+    while True:
+        keyset = "AND (e.sent_at, e.id) > (?, ?)" if after else ""
+        rows = conn.execute(f"""
+            SELECT e.id, e.sent_at, e.recipient_email, e.subject, e.job_id, e.account_id, a.email,
+                   e.message_id, e.thread_id, e.replied_at, e.bounced_at
+            FROM emails_sent e LEFT JOIN gmail_accounts a ON a.id = e.account_id
+            WHERE {where} {keyset}
+            ORDER BY e.sent_at, e.id LIMIT ?
+        """, params + list(after or ()) + [batch_size]).fetchall()
+        yield from rows
+        if len(rows) < batch_size:
+            return
+        after = (rows[-1][1], rows[-1][0])
+
 def count_total_csvs(user_id):
     """Count total CSVs uploaded by user"""
+    cur = conn.cursor()
     cur.execute("SELECT COUNT(*) FROM csvs WHERE user_id=?", (user_id,))
     return cur.fetchone()[0]
 
@@ -136,6 +250,7 @@ def count_total_csvs(user_id):
 
 def create_session(user_id, user_data):
     """Create a new session and return session ID"""
+    cur = conn.cursor()
     session_id = str(uuid.uuid4())
     expires_at = datetime.now() + timedelta(days=30)
     
@@ -148,6 +263,7 @@ def create_session(user_id, user_data):
 
 def get_session(session_id):
     """Retrieve session data by session ID"""
+    cur = conn.cursor()
     cur.execute("""
         SELECT user_id, data FROM sessions 
         WHERE session_id=? AND expires_at > datetime('now')
@@ -162,25 +278,24 @@ def get_session(session_id):
 
 def delete_session(session_id):
     """Delete a session"""
+    cur = conn.cursor()
     cur.execute("DELETE FROM sessions WHERE session_id=?", (session_id,))
     conn.commit()
 
 def delete_csv(csv_id, user_id):
     """Delete a CSV file"""
+    cur = conn.cursor()
     cur.execute("DELETE FROM csvs WHERE id=? AND user_id=?", (csv_id, user_id))
+    if cur.rowcount:
+        cur.execute("DELETE FROM csv_rows WHERE csv_id=?", (csv_id,))
+        cur.execute("DELETE FROM segments WHERE csv_id=?", (csv_id,))
     conn.commit()
 
-def log_email_sent(user_id, recipient_email, subject):
-    """Log a sent email"""
-    cur.execute("""
-        INSERT INTO emails_sent (user_id, recipient_email, subject)
-        VALUES (?, ?, ?)
-    """, (user_id, recipient_email, subject))
-    conn.commit()
 # ===== GMAIL ACCOUNT MANAGEMENT =====
 
 def add_gmail_account(user_id, gmail_id, email, name, access_token, refresh_token):
     """Add a new Gmail account for the user (encrypted)"""
+    cur = conn.cursor()
     # Encrypt tokens before storing
     encrypted_access = encrypt_token(access_token)
     encrypted_refresh = encrypt_token(refresh_token) if refresh_token else None
@@ -194,6 +309,7 @@ def add_gmail_account(user_id, gmail_id, email, name, access_token, refresh_toke
 
 def get_gmail_accounts(user_id):
     """Get all Gmail accounts for a user (decrypted)"""
+    cur = conn.cursor()
     cur.execute("""
         SELECT id, gmail_id, email, name, access_token, refresh_token
         FROM gmail_accounts WHERE user_id=? ORDER BY added_at DESC
@@ -213,6 +329,7 @@ def get_gmail_accounts(user_id):
 
 def get_gmail_account(account_id, user_id):
     """Get a specific Gmail account (decrypted)"""
+    cur = conn.cursor()
     cur.execute("""
         SELECT id, gmail_id, email, name, access_token, refresh_token
         FROM gmail_accounts WHERE id=? AND user_id=?
@@ -231,11 +348,13 @@ def get_gmail_account(account_id, user_id):
 
 def count_gmail_accounts(user_id):
     """Count total Gmail accounts for a user"""
+    cur = conn.cursor()
     cur.execute("SELECT COUNT(*) FROM gmail_accounts WHERE user_id=?", (user_id,))
     return cur.fetchone()[0]
 
 def update_gmail_tokens(account_id, access_token, refresh_token=None):
     """Update tokens for a Gmail account (encrypted)"""
+    cur = conn.cursor()
     # Encrypt tokens before storing
     encrypted_access = encrypt_token(access_token)
     encrypted_refresh = encrypt_token(refresh_token) if refresh_token else None
@@ -254,11 +373,13 @@ def update_gmail_tokens(account_id, access_token, refresh_token=None):
 
 def delete_gmail_account(account_id, user_id):
     """Delete a Gmail account"""
+    cur = conn.cursor()
     cur.execute("DELETE FROM gmail_accounts WHERE id=? AND user_id=?", (account_id, user_id))
     conn.commit()
 
 def update_gmail_account_name(account_id, user_id, name):
     """Update the name/display name for a Gmail account"""
+    cur = conn.cursor()
     cur.execute("""
         UPDATE gmail_accounts SET name=?
         WHERE id=? AND user_id=?
@@ -267,6 +388,7 @@ def update_gmail_account_name(account_id, user_id, name):
 
 def update_user_gmail_tokens(user_id, access_token, refresh_token):
     """Update tokens for the main user account (encrypted)"""
+    cur = conn.cursor()
     # Encrypt tokens before storing
     encrypted_access = encrypt_token(access_token)
     encrypted_refresh = encrypt_token(refresh_token) if refresh_token else None
@@ -279,6 +401,7 @@ def update_user_gmail_tokens(user_id, access_token, refresh_token):
 
 def get_user_gmail_tokens(user_id):
     """Get Gmail tokens for the main user account (decrypted)"""
+    cur = conn.cursor()
     cur.execute("""
         SELECT gmail_token, gmail_refresh_token FROM users WHERE id=?
     """, (user_id,))
@@ -289,3 +412,520 @@ def get_user_gmail_tokens(user_id):
             "refresh_token": decrypt_token(row[1]) if row[1] else None
         }
     return None
+
+# ===== ATTACHMENTS =====
+
+def save_attachment(user_id, filename, mime_type, content):
+    """Store an attachment keyed by content hash and return its ID"""
+    cur = conn.cursor()
+    sha256 = hashlib.sha256(content).hexdigest()
+    # Identical files share one blob across users and campaigns
+    cur.execute("""
+        INSERT OR IGNORE INTO attachment_blobs (sha256, content, size)
+        VALUES (?, ?, ?)
+    """, (sha256, content, len(content)))
+
+    cur.execute("""
+        SELECT id FROM attachments WHERE user_id=? AND sha256=? AND filename=?
+    """, (user_id, sha256, filename))
+    row = cur.fetchone()
+    if row:
+        conn.commit()
+        return row[0]
+
+    cur.execute("""
+        INSERT INTO attachments (user_id, sha256, filename, mime_type)
+        VALUES (?, ?, ?, ?)
+    """, (user_id, sha256, filename, mime_type))
+    conn.commit()
+    return cur.lastrowid
+
+def get_attachments(user_id):
+    """Get attachment metadata for a user"""
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT a.id, a.filename, a.mime_type, b.size, a.uploaded_at
+        FROM attachments a JOIN attachment_blobs b ON b.sha256 = a.sha256
+        WHERE a.user_id=? ORDER BY a.uploaded_at DESC
+    """, (user_id,))
+    return cur.fetchall()
+
+def get_attachment(attachment_id, user_id):
+    """Get a specific attachment with its content: (id, filename, mime_type, sha256, content)"""
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT a.id, a.filename, a.mime_type, a.sha256, b.content
+        FROM attachments a JOIN attachment_blobs b ON b.sha256 = a.sha256
+        WHERE a.id=? AND a.user_id=?
+    """, (attachment_id, user_id))
+    return cur.fetchone()
+
+def get_attachment_info(attachment_id, user_id):
+    """An attachment without its content: (id, filename, mime_type, sha256)"""
+    return conn.execute("""
+        SELECT id, filename, mime_type, sha256 FROM attachments WHERE id=? AND user_id=?
+    """, (attachment_id, user_id)).fetchone()
+
+def get_attachment_blob(sha256):
+    """An attachment's content by hash, or None"""
+    row = conn.execute("SELECT content FROM attachment_blobs WHERE sha256=?", (sha256,)).fetchone()
+    return row[0] if row else None
+
+def delete_attachment(attachment_id, user_id):
+    """
+    Delete an attachment, dropping its blob once nothing references it.
+    Returns False, deleting nothing, while an unfinished send job uses it.
+    """
+    cur = conn.cursor()
+    cur.execute("SELECT sha256 FROM attachments WHERE id=? AND user_id=?", (attachment_id, user_id))
+    row = cur.fetchone()
+    if not row:
+        return True
+    cur.execute("""
+        SELECT 1 FROM send_jobs j, json_each(j.attachment_ids) a
+        WHERE j.user_id=? AND j.status IN ('queued', 'running') AND CAST(a.value AS INTEGER)=?
+        LIMIT 1
+    """, (user_id, attachment_id))
+    if cur.fetchone():
+        return False
+    cur.execute("DELETE FROM attachments WHERE id=? AND user_id=?", (attachment_id, user_id))
+    cur.execute("""
+        DELETE FROM attachment_blobs
+        WHERE sha256=? AND NOT EXISTS (SELECT 1 FROM attachments WHERE sha256=?)
+    """, (row[0], row[0]))
+    conn.commit()
+    return True
+
+# ===== TEMPLATES =====
+
+def save_template(user_id, name, subject, body, is_html=False):
+    """Save a new version of a named template and return its ID"""
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT COALESCE(MAX(version), 0) FROM templates WHERE user_id=? AND name=?
+    """, (user_id, name))
+    version = cur.fetchone()[0] + 1
+    cur.execute("""
+        INSERT INTO templates (user_id, name, version, subject, body, is_html)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, (user_id, name, version, subject, body, int(bool(is_html))))
+    conn.commit()
+    return cur.lastrowid
+
+def get_templates(user_id):
+    """Get the latest version of each template for a user"""
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT id, name, version, subject, body, is_html, created_at
+        FROM templates t
+        WHERE user_id=? AND version = (
+            SELECT MAX(version) FROM templates WHERE user_id=t.user_id AND name=t.name
+        )
+        ORDER BY created_at DESC
+    """, (user_id,))
+    return cur.fetchall()
+
+def get_template(template_id, user_id):
+    """Get a specific template version: (id, name, version, subject, body, is_html, created_at)"""
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT id, name, version, subject, body, is_html, created_at
+        FROM templates WHERE id=? AND user_id=?
+    """, (template_id, user_id))
+    return cur.fetchone()
+
+def get_template_versions(user_id, name):
+    """Get all versions of a named template, newest first"""
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT id, name, version, subject, body, is_html, created_at
+        FROM templates WHERE user_id=? AND name=? ORDER BY version DESC
+    """, (user_id, name))
+    return cur.fetchall()
+
+def delete_template(user_id, name):
+    """Delete every version of a named template"""
+    cur = conn.cursor()
+    cur.execute("DELETE FROM templates WHERE user_id=? AND name=?", (user_id, name))
+    conn.commit()
+
+# ===== SEGMENTS =====
+
+def save_segment(user_id, csv_id, name, filter_expression):
+    cur = conn.cursor()
+    cur.execute(
+        "INSERT INTO segments (user_id, csv_id, name, filter) VALUES (?, ?, ?, ?)",
+        (user_id, csv_id, name, filter_expression),
+    )
+    conn.commit()
+    return cur.lastrowid
+
+def get_segments(user_id, csv_id=None):
+    """A user's segments, optionally of one CSV: [(id, csv_id, name, filter, created_at)]"""
+    query = "SELECT id, csv_id, name, filter, created_at FROM segments WHERE user_id=?"
+    params = [user_id]
+    if csv_id is not None:
+        query += " AND csv_id=?"
+        params.append(csv_id)
+    return conn.execute(query + " ORDER BY id", params).fetchall()
+
+def get_segment(segment_id, user_id):
+    """(id, csv_id, name, filter, created_at), or None if it isn't the user's"""
+    return conn.execute("""
+        SELECT id, csv_id, name, filter, created_at FROM segments WHERE id=? AND user_id=?
+    """, (segment_id, user_id)).fetchone()
+
+def delete_segment(segment_id, user_id):
+    conn.execute("DELETE FROM segments WHERE id=? AND user_id=?", (segment_id, user_id))
+    conn.commit()
+
+# ===== SEND JOBS =====
+
+def create_send_job(job_id, user_id, csv_id, email_column, subject, body, is_html,
+                    sender_account_ids, attachment_ids, priority=0, row_indexes=None, segment_id=None):
+    """
+    Queue a send job with one item per recipient row (only row_indexes, if
+    given), leaving out the user's suppressed addresses; returns the recipient count
+    """
+    cur = conn.cursor()
+    cur.execute("""
+        INSERT INTO send_jobs (id, user_id, csv_id, subject, body, is_html, sender_account_ids,
+                               attachment_ids, priority, segment_id)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, (job_id, user_id, csv_id, subject, body, int(bool(is_html)),
+          json.dumps(sender_account_ids), json.dumps(attachment_ids), priority, segment_id))
+
+    email_path = f"$[{int(email_column)}]"
+    params = [job_id, email_path, csv_id]
+    row_filter = ""
+    if row_indexes is not None:
+        row_filter = "AND row_index IN (SELECT value FROM json_each(?))"
+        params.append(json.dumps(row_indexes))
+    cur.execute(f"""
+        INSERT INTO send_job_items (job_id, row_index, email, domain, domain_seq)
+        SELECT ?, row_index, email, domain,
+               ROW_NUMBER() OVER (PARTITION BY domain ORDER BY row_index)
+        FROM (
+            SELECT row_index, email, LOWER(SUBSTR(email, INSTR(email, '@') + 1)) AS domain
+            FROM (
+                SELECT row_index, TRIM(json_extract(data, ?)) AS email FROM csv_rows
+                WHERE csv_id=? {row_filter}
+            )
+            WHERE email LIKE '%_@_%'
+            AND LOWER(email) NOT IN (SELECT email FROM suppressions WHERE user_id=?)
+        )
+    """, params + [user_id])
+    total = cur.rowcount
+
+    cur.execute("UPDATE send_jobs SET total=? WHERE id=?", (total, job_id))
+    conn.commit()
+    return total
+
+def get_send_job(job_id, user_id=None):
+    """
+    Get a send job: (id, user_id, csv_id, subject, body, is_html, sender_account_ids,
+    attachment_ids, status, total, sent, failed, error, replies, bounces)
+    """
+    query = """
+        SELECT id, user_id, csv_id, subject, body, is_html, sender_account_ids,
+               attachment_ids, status, total, sent, failed, error, replies, bounces
+        FROM send_jobs WHERE id=?
+    """
+    params = (job_id,)
+    if user_id is not None:
+        query += " AND user_id=?"
+        params = (job_id, user_id)
+    row = conn.execute(query, params).fetchone()
+    if not row:
+        return None
+    return row[:6] + (json.loads(row[6]), json.loads(row[7])) + row[8:]
+
+def runnable_send_jobs(exclude=()):
+    """
+    Jobs with recipients due to be sent now, each tenant's next job first:
+    [(job_id, user_id, send_weight, max_concurrent_jobs)]
+    """
+    exclude = list(exclude)
+    return conn.execute(f"""
+        SELECT j.id, j.user_id, u.send_weight, u.max_concurrent_jobs
+        FROM send_jobs j JOIN users u ON u.id = j.user_id
+        WHERE (j.status = 'queued' OR (j.status = 'running' AND EXISTS (
+            SELECT 1 FROM send_job_items i
+            WHERE i.job_id = j.id AND i.status = 'pending'
+            AND (i.next_attempt_at IS NULL OR i.next_attempt_at <= ?)
+        )))
+        AND j.id NOT IN ({",".join("?" * len(exclude))})
+        ORDER BY j.priority DESC, j.created_at, j.rowid
+    """, [time.time()] + exclude).fetchall()
+
+def claim_send_items(job_id, limit):
+    """
+    Mark up to limit pending items that are due as claimed, interleaving
+    recipient domains (the first recipient of every domain, then the second...).
+    Returns [(row_index, email, values, attempts)]
+    """
+    rows = conn.execute("""
+        SELECT i.row_index, i.email, r.data, i.attempts
+        FROM send_job_items i
+        JOIN send_jobs j ON j.id = i.job_id
+        JOIN csv_rows r ON r.csv_id = j.csv_id AND r.row_index = i.row_index
+        WHERE i.job_id=? AND i.status='pending'
+        AND (i.next_attempt_at IS NULL OR i.next_attempt_at <= ?)
+        ORDER BY i.domain_seq, i.row_index LIMIT ?
+    """, (job_id, time.time(), limit)).fetchall()
+    conn.executemany("""
+        UPDATE send_job_items SET status='claimed', updated_at=CURRENT_TIMESTAMP
+        WHERE job_id=? AND row_index=?
+    """, [(job_id, row[0]) for row in rows])
+    conn.execute("""
+        UPDATE send_jobs SET status='running', updated_at=CURRENT_TIMESTAMP
+        WHERE id=? AND status='queued'
+    """, (job_id,))
+    conn.commit()
+    return [(row_index, email, json.loads(data), attempts) for row_index, email, data, attempts in rows]
+
+def record_sent_item(job_id, user_id, subject, row_index, email, account_id, message_id, thread_id):
+    """
+    Checkpoint a sent recipient, count it against its account and log it, in
+    one transaction, so a failed write can be retried without double counting
+    """
+    try:
+        conn.execute("""
+            UPDATE send_job_items SET status='sent', error=NULL, updated_at=CURRENT_TIMESTAMP
+            WHERE job_id=? AND row_index=?
+        """, (job_id, row_index))
+        conn.execute("UPDATE send_jobs SET sent=sent+1, updated_at=CURRENT_TIMESTAMP WHERE id=?", (job_id,))
+        conn.execute("""
+            INSERT INTO account_usage (account_id, day, sent) VALUES (?, date('now'), 1)
+            ON CONFLICT(account_id, day) DO UPDATE SET sent = sent + 1
+        """, (account_id,))
+        conn.execute("""
+            INSERT INTO emails_sent (user_id, recipient_email, subject, job_id, account_id, message_id, thread_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, (user_id, email, subject, job_id, account_id, message_id, thread_id))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+def retry_send_item(job_id, row_index, error, delay):
+    """Put a transiently failed item back in the queue, due again in delay seconds"""
+    conn.execute("""
+        UPDATE send_job_items
+        SET status='pending', error=?, attempts=attempts+1, next_attempt_at=?, updated_at=CURRENT_TIMESTAMP
+        WHERE job_id=? AND row_index=?
+    """, (error, time.time() + delay, job_id, row_index))
+    conn.commit()
+
+def dead_letter_send_item(job_id, row_index, error, kind):
+    """Fail an item for good and record it in the dead-letter table"""
+    conn.execute("""
+        UPDATE send_job_items
+        SET status='failed', error=?, attempts=attempts+1, next_attempt_at=NULL, updated_at=CURRENT_TIMESTAMP
+        WHERE job_id=? AND row_index=?
+    """, (error, job_id, row_index))
+    conn.execute("""
+        INSERT INTO dead_letters (user_id, job_id, row_index, email, kind, error, attempts)
+        SELECT j.user_id, i.job_id, i.row_index, i.email, ?, i.error, i.attempts
+        FROM send_job_items i JOIN send_jobs j ON j.id = i.job_id
+        WHERE i.job_id=? AND i.row_index=?
+    """, (kind, job_id, row_index))
+    conn.execute("""
+        UPDATE send_jobs SET failed=failed+1, updated_at=CURRENT_TIMESTAMP WHERE id=?
+    """, (job_id,))
+    conn.commit()
+
+def release_send_items(job_id):
+    """Return a job's claimed-but-unsent items to the queue"""
+    conn.execute("""
+        UPDATE send_job_items SET status='pending', updated_at=CURRENT_TIMESTAMP
+        WHERE job_id=? AND status='claimed'
+    """, (job_id,))
+    conn.commit()
+
+def reset_claimed_send_items():
+    """Requeue items claimed by a sender process that died mid-send"""
+    conn.execute("UPDATE send_job_items SET status='pending' WHERE status='claimed'")
+    conn.commit()
+
+def finish_send_job(job_id, status="done", error=None):
+    """Close a job once nothing is pending or claimed (always, for failures)"""
+    if status == "done":
+        remaining = conn.execute("""
+            SELECT 1 FROM send_job_items
+            WHERE job_id=? AND status IN ('pending', 'claimed') LIMIT 1
+        """, (job_id,)).fetchone()
+        if remaining:
+            return False
+    conn.execute("""
+        UPDATE send_jobs SET status=?, error=?, updated_at=CURRENT_TIMESTAMP WHERE id=?
+    """, (status, error, job_id))
+    conn.commit()
+    return True
+
+# ===== ACCOUNT USAGE =====
+
+def get_account_usage(account_ids):
+    """Today's (UTC) usage per account: {account_id: (sent_today, daily_limit or None)}"""
+    usage = {}
+    for account_id in account_ids:
+        row = conn.execute("""
+            SELECT COALESCE(u.sent, 0), a.daily_limit
+            FROM gmail_accounts a
+            LEFT JOIN account_usage u ON u.account_id = a.id AND u.day = date('now')
+            WHERE a.id=?
+        """, (account_id,)).fetchone()
+        if row:
+            usage[account_id] = row
+    return usage
+
+def record_account_send(account_id, sent):
+    """Count one send attempt against an account's daily usage"""
+    column = "sent" if sent else "failed"
+    conn.execute(f"""
+        INSERT INTO account_usage (account_id, day, {column}) VALUES (?, date('now'), 1)
+        ON CONFLICT(account_id, day) DO UPDATE SET {column} = {column} + 1
+    """, (account_id,))
+    conn.commit()
+
+def get_account_health(account_ids):
+    """{account_id: (circuit_state, health_score, open_until, consecutive_failures, last_error)}"""
+    health = {}
+    for account_id in account_ids:
+        row = conn.execute("""
+            SELECT circuit_state, health_score, circuit_open_until, consecutive_failures, last_error
+            FROM gmail_accounts WHERE id=?
+        """, (account_id,)).fetchone()
+        if row:
+            health[account_id] = row
+    return health
+
+def save_account_health(account_id, state, score, open_until, failures, last_error):
+    conn.execute("""
+        UPDATE gmail_accounts
+        SET circuit_state=?, health_score=?, circuit_open_until=?, consecutive_failures=?,
+            last_error=COALESCE(?, last_error), health_updated_at=CURRENT_TIMESTAMP
+        WHERE id=?
+    """, (state, score, open_until, failures, last_error, account_id))
+    conn.commit()
+
+# ===== DEAD LETTERS =====
+
+def _dead_letter_filter(user_id, ids=None, job_id=None, kind=None):
+    clauses = ["user_id=?"]
+    params = [user_id]
+    if ids is not None:
+        clauses.append(f"id IN ({','.join('?' * len(ids))})")
+        params.extend(ids)
+    if job_id:
+        clauses.append("job_id=?")
+        params.append(job_id)
+    if kind:
+        clauses.append("kind=?")
+        params.append(kind)
+    return " AND ".join(clauses), params
+
+def get_dead_letters(user_id, job_id=None, kind=None, after=0, limit=50):
+    """Page of (id, job_id, row_index, email, kind, error, attempts, created_at) after id"""
+    where, params = _dead_letter_filter(user_id, job_id=job_id, kind=kind)
+    return conn.execute(f"""
+        SELECT id, job_id, row_index, email, kind, error, attempts, created_at
+        FROM dead_letters WHERE {where} AND id > ?
+        ORDER BY id LIMIT ?
+    """, params + [after, limit]).fetchall()
+
+def redrive_dead_letters(user_id, ids=None, job_id=None, kind=None):
+    """
+    Queue dead-lettered recipients for sending again, with a fresh attempt
+    count, and remove them from the table. Returns {job_id: count}.
+    """
+    where, params = _dead_letter_filter(user_id, ids, job_id, kind)
+    rows = conn.execute(f"SELECT id, job_id, row_index FROM dead_letters WHERE {where}", params).fetchall()
+    conn.executemany("""
+        UPDATE send_job_items
+        SET status='pending', error=NULL, attempts=0, next_attempt_at=NULL, updated_at=CURRENT_TIMESTAMP
+        WHERE job_id=? AND row_index=? AND status='failed'
+    """, [(job, row_index) for _, job, row_index in rows])
+    conn.executemany("DELETE FROM dead_letters WHERE id=?", [(dead_id,) for dead_id, _, _ in rows])
+
+    counts = {}
+    for _, job, _ in rows:
+        counts[job] = counts.get(job, 0) + 1
+    for job, count in counts.items():
+        conn.execute("""
+            UPDATE send_jobs SET failed=failed-?, status='running', error=NULL, updated_at=CURRENT_TIMESTAMP
+            WHERE id=?
+        """, (count, job))
+    conn.commit()
+    return counts
+
+# ===== MAILBOX SYNC =====
+
+def get_sync_accounts():
+    """Every account that can be synced: [(id, user_id, email, name, access_token, refresh_token, history_id)]"""
+    rows = conn.execute("""
+        SELECT id, user_id, email, name, access_token, refresh_token, history_id
+        FROM gmail_accounts WHERE refresh_token IS NOT NULL
+    """).fetchall()
+    return [
+        (id, user_id, email, name, decrypt_token(access_token), decrypt_token(refresh_token), history_id)
+        for id, user_id, email, name, access_token, refresh_token, history_id in rows
+    ]
+
+def set_history_id(account_id, history_id):
+    conn.execute("""
+        UPDATE gmail_accounts SET history_id=?, last_synced_at=CURRENT_TIMESTAMP WHERE id=?
+    """, (history_id, account_id))
+    conn.commit()
+
+def find_sent_by_thread(account_id, thread_ids):
+    """{thread_id: (emails_sent id, recipient_email)} for threads this account started"""
+    thread_ids = list(thread_ids)
+    if not thread_ids:
+        return {}
+    rows = conn.execute(f"""
+        SELECT thread_id, id, recipient_email FROM emails_sent
+        WHERE account_id=? AND thread_id IN ({",".join("?" * len(thread_ids))})
+    """, [account_id] + thread_ids).fetchall()
+    return {thread_id: (sent_id, email) for thread_id, sent_id, email in rows}
+
+def find_sent_to(account_id, recipient_email):
+    """Latest emails_sent id from an account to an address, or None"""
+    row = conn.execute("""
+        SELECT id FROM emails_sent WHERE account_id=? AND recipient_email=? COLLATE NOCASE
+        ORDER BY id DESC LIMIT 1
+    """, (account_id, recipient_email)).fetchone()
+    return row[0] if row else None
+
+def record_mailbox_event(sent_id, kind):
+    """
+    Mark a sent email as replied to or bounced ('reply' or 'bounce'), count it
+    on its campaign and suppress the address. Returns False if already recorded.
+    """
+    column, counter = ("replied_at", "replies") if kind == "reply" else ("bounced_at", "bounces")
+    cur = conn.cursor()
+    cur.execute(f"""
+        UPDATE emails_sent SET {column}=CURRENT_TIMESTAMP WHERE id=? AND {column} IS NULL
+    """, (sent_id,))
+    if not cur.rowcount:
+        return False
+    user_id, email, job_id = cur.execute(
+        "SELECT user_id, recipient_email, job_id FROM emails_sent WHERE id=?", (sent_id,)
+    ).fetchone()
+    cur.execute(f"UPDATE send_jobs SET {counter}={counter}+1 WHERE id=?", (job_id,))
+    cur.execute("""
+        INSERT OR IGNORE INTO suppressions (user_id, email, reason, job_id) VALUES (?, ?, ?, ?)
+    """, (user_id, email.lower(), kind, job_id))
+    conn.commit()
+    return True
+
+def get_suppressions(user_id, after="", limit=50):
+    """Page of (email, reason, job_id, created_at) ordered by email"""
+    return conn.execute("""
+        SELECT email, reason, job_id, created_at FROM suppressions
+        WHERE user_id=? AND email > ? ORDER BY email LIMIT ?
+    """, (user_id, after, limit)).fetchall()
+
+def delete_suppression(user_id, email):
+    conn.execute("DELETE FROM suppressions WHERE user_id=? AND email=?", (user_id, email.lower()))
+    conn.commit()
@@ -0,0 +1,214 @@
+"""Quota- and health-aware routing of recipients across sender accounts"""
+import os
+import time
+
+# Gmail allows 500 sends/day for consumer accounts, 2000 for Workspace
+ACCOUNT_DAILY_LIMIT = int(os.getenv("ACCOUNT_DAILY_LIMIT", "500"))
+# How long an account Gmail is rate limiting gets no new work
+THROTTLE_COOLDOWN_SECONDS = float(os.getenv("THROTTLE_COOLDOWN_SECONDS", "60"))
+# Consecutive auth/quota failures that open an account's circuit breaker
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "3"))
+# How long an open breaker waits before letting a single trial send through
+CIRCUIT_OPEN_SECONDS = float(os.getenv("CIRCUIT_OPEN_SECONDS", "300"))
+# Weight of the latest send in the success-rate and latency averages
+EWMA_WEIGHT = 0.2
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+
+class AccountsUnavailable(Exception):
+    """No sender account can take sends until retry_after seconds have passed"""
+
+    def __init__(self, retry_after=None):
+        super().__init__("No sender account is available")
+        self.retry_after = retry_after
+
+
+class QuotaExhausted(AccountsUnavailable):
+    """Every sender account has used its daily quota"""
+
+
+def http_status(error):
+    """HTTP status of a googleapiclient HttpError, or None for other errors"""
+    resp = getattr(error, "resp", None)
+    return getattr(resp, "status", None)
+
+
+def is_auth_error(error):
+    # A 401 that survived a token refresh, or the refresh itself failing
+    # (revoked or expired refresh token)
+    return (
+        http_status(error) == 401
+        or type(error).__name__ == "RefreshError"
+        or "invalid_grant" in str(error)
+    )
+
+
+def is_daily_limit(error):
+    return http_status(error) == 403 and "daily" in str(error).lower()
+
+
+def is_throttled(error):
+    status = http_status(error)
+    return status == 429 or (status == 403 and "ratelimitexceeded" in str(error).lower())
+
+
+def is_account_error(error):
+    """True when a failure says nothing about the recipient, only the sending account"""
+    return is_auth_error(error) or is_daily_limit(error) or is_throttled(error)
+
+
+class AccountLoad:
+    """Live load, quota and breaker state for one sender account"""
+    __slots__ = (
+        "account", "remaining", "in_flight", "success_rate", "latency", "cooldown_until",
+        "state", "failures", "open_until", "last_error",
+    )
+
+    def __init__(self, account, remaining, state=CLOSED, success_rate=1.0, open_until=0.0, failures=0):
+        self.account = account
+        self.remaining = remaining
+        self.in_flight = 0
+        self.success_rate = success_rate
+        self.latency = 0.5
+        self.cooldown_until = 0.0
+        self.state = state
+        self.failures = failures
+        self.open_until = open_until or 0.0
+        self.last_error = None
+
+    def score(self):
+        # More quota left, fewer failures, less queued work and faster sends
+        # all earn a bigger share of the recipients
+        return self.remaining * self.success_rate / ((self.in_flight + 1) * max(self.latency, 0.05))
+
+    def ready_at(self):
+        """When the account can next take a send (ignoring in-flight limits)"""
+        if self.state == OPEN:
+            return max(self.open_until, self.cooldown_until)
+        return self.cooldown_until
+
+
+class AccountDispatcher:
+    """
+    Picks the sender account with the most headroom for each recipient and
+    keeps a circuit breaker per account.
+    usage: {account_id: (sent_today, daily_limit or None)}
+    health: {account_id: (state, score, open_until, failures)} from the last run
+    on_health: optional callback(account_id, state, score, open_until, failures, error),
+    invoked when a breaker changes state and by report()
+    Not thread-safe; it is only used from a batch's dispatching thread.
+    """
+
+    def __init__(self, accounts, usage=None, max_in_flight=8, health=None, on_health=None):
+        usage = usage or {}
+        health = health or {}
+        self.max_in_flight = max_in_flight
+        self.on_health = on_health
+        self.loads = {}
+        for account in accounts:
+            sent_today, daily_limit = usage.get(account.id, (0, None))
+            state, score, open_until, failures = health.get(account.id, (CLOSED, 1.0, 0.0, 0))
+            self.loads[account.id] = AccountLoad(
+                account, (daily_limit or ACCOUNT_DAILY_LIMIT) - sent_today,
+                state or CLOSED, 1.0 if score is None else score, open_until, failures or 0,
+            )
+
+    def _best(self, avoid=()):
+        now = time.time()
+        best = None
+        with_quota = [load for load in self.loads.values() if load.remaining > 0]
+        if not with_quota:
+            raise QuotaExhausted()
+
+        for load in with_quota:
+            if load.state == OPEN and load.open_until <= now:
+                self._set_state(load, HALF_OPEN)
+            if load.state == OPEN or load.cooldown_until > now:
+                continue
+            # A half-open breaker lets exactly one trial send through
+            limit = 1 if load.state == HALF_OPEN else self.max_in_flight
+            if load.in_flight >= limit:
+                continue
+            if best is None or (load.account.id in avoid, -load.score()) < (best.account.id in avoid, -best.score()):
+                best = load
+
+        if best is None and all(load.state == OPEN for load in with_quota):
+            raise AccountsUnavailable(min(load.open_until for load in with_quota) - now)
+        return best
+
+    def has_capacity(self):
+        """Whether pick() would return an account right now (same exceptions as pick)"""
+        return self._best() is not None
+
+    def pick(self, avoid=()):
+        """
+        Best account that can take another send right now, or None if all
+        are busy or cooling down. Accounts in avoid (ids that already failed
+        this recipient) are only used when nothing else can take it.
+        Raises QuotaExhausted when no account has quota left and
+        AccountsUnavailable when every breaker with quota is open.
+        """
+        best = self._best(avoid)
+        if best is None:
+            return None
+
+        # Reserve quota now; finished() refunds it if the send fails
+        best.in_flight += 1
+        best.remaining -= 1
+        return best.account
+
+    def wait_time(self):
+        """Seconds until a cooling account can take work again"""
+        now = time.time()
+        waits = [load.ready_at() - now for load in self.loads.values() if load.remaining > 0]
+        return max(min(waits, default=0.0), 0.05)
+
+    def finished(self, account, success, latency, error=None):
+        load = self.loads[account.id]
+        load.in_flight -= 1
+        load.latency += EWMA_WEIGHT * (latency - load.latency)
+        load.success_rate += EWMA_WEIGHT * ((1.0 if success else 0.0) - load.success_rate)
+        if success:
+            load.failures = 0
+            if load.state != CLOSED:
+                self._set_state(load, CLOSED)
+            return
+
+        load.remaining += 1
+        if not is_account_error(error):
+            return
+
+        load.failures += 1
+        load.last_error = str(error)
+        if is_daily_limit(error):
+            print(f"⚠️ {account.email} hit its daily sending limit")
+            load.remaining = 0
+        elif is_throttled(error):
+            print(f"⚠️ {account.email} is being rate limited; pausing it")
+            load.cooldown_until = time.time() + THROTTLE_COOLDOWN_SECONDS
+
+        # Sends already in flight when the breaker opened don't re-open it
+        if load.state == HALF_OPEN or (load.state == CLOSED and load.failures >= CIRCUIT_FAILURE_THRESHOLD):
+            load.open_until = time.time() + CIRCUIT_OPEN_SECONDS
+            self._set_state(load, OPEN)
+
+    def _set_state(self, load, state):
+        if state == OPEN:
+            print(f"🔌 Circuit opened for {load.account.email}: {load.last_error}")
+        elif state == CLOSED:
+            print(f"✅ Circuit closed for {load.account.email}")
+        load.state = state
+        self._report(load)
+
+    def _report(self, load):
+        if self.on_health:
+            self.on_health(
+                load.account.id, load.state, round(load.success_rate, 3),
+                load.open_until, load.failures, load.last_error,
+            )
+
+    def report(self):
+        """Publish every account's current health"""
+        for load in self.loads.values():
+            self._report(load)
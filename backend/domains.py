@@ -0,0 +1,128 @@
+"""Per-recipient-domain pacing so no receiving domain sees a burst"""
+import os
+import threading
+import time
+from collections import deque
+
+import shared_state
+
+# Defaults for every domain; DOMAIN_LIMITS overrides them per domain as
+# "domain=sends_per_minute:max_concurrent,...", e.g. "gmail.com=600:8,acme.com=20:1"
+DOMAIN_SENDS_PER_MINUTE = float(os.getenv("DOMAIN_SENDS_PER_MINUTE", "60"))
+DOMAIN_MAX_CONCURRENT = int(os.getenv("DOMAIN_MAX_CONCURRENT", "2"))
+DOMAIN_SEND_BURST = float(os.getenv("DOMAIN_SEND_BURST", "5"))
+
+
+def parse_domain_limits(spec):
+    """{domain: (sends_per_minute, max_concurrent)} from a DOMAIN_LIMITS string"""
+    limits = {}
+    for entry in filter(None, (e.strip() for e in spec.split(","))):
+        domain, _, limit = entry.partition("=")
+        per_minute, _, concurrent = limit.partition(":")
+        limits[domain.strip().lower()] = (
+            float(per_minute or DOMAIN_SENDS_PER_MINUTE),
+            int(concurrent or DOMAIN_MAX_CONCURRENT),
+        )
+    return limits
+
+
+DOMAIN_LIMITS = parse_domain_limits(os.getenv("DOMAIN_LIMITS", ""))
+
+
+def domain_of(email):
+    return email.rpartition("@")[2].strip().lower()
+
+
+def domain_limits(domain):
+    """(sends_per_minute, max_concurrent) for a recipient domain"""
+    return DOMAIN_LIMITS.get(domain, (DOMAIN_SENDS_PER_MINUTE, DOMAIN_MAX_CONCURRENT))
+
+
+class DomainSlots:
+    """
+    Sends in flight per recipient domain. Batches running at the same time
+    share one instance, so a domain's max_concurrent holds across all of them.
+    """
+
+    def __init__(self):
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def take(self, domain, limit):
+        """Claim a send slot for domain; False if it already has limit sends in flight"""
+        with self._lock:
+            count = self._counts.get(domain, 0)
+            if count >= limit:
+                return False
+            self._counts[domain] = count + 1
+            return True
+
+    def release(self, domain):
+        with self._lock:
+            count = self._counts[domain] - 1
+            if count:
+                self._counts[domain] = count
+            else:
+                del self._counts[domain]
+
+
+class DomainScheduler:
+    """
+    Holds rendered messages per recipient domain and hands them out round-robin,
+    only from domains under their concurrency limit (counted in slots, which
+    other batches may share) with a send token in their shared (cross-process)
+    rate bucket. Used from a batch's dispatching thread.
+    """
+
+    def __init__(self, slots=None):
+        self.queues = {}
+        self.slots = DomainSlots() if slots is None else slots
+        # Domains whose rate bucket was empty, and when to ask again
+        self.not_before = {}
+        self.rotation = deque()
+        self.size = 0
+
+    def add(self, message, tried=frozenset(), front=False):
+        domain = domain_of(message[0].email)
+        items = self.queues.get(domain)
+        if items is None:
+            items = self.queues[domain] = deque()
+            self.rotation.append(domain)
+        if front:
+            items.appendleft((message, tried))
+        else:
+            items.append((message, tried))
+        self.size += 1
+
+    def next_ready(self):
+        """(message, tried) from the next domain allowed to send now, or None"""
+        now = time.monotonic()
+        for _ in range(len(self.rotation)):
+            domain = self.rotation[0]
+            self.rotation.rotate(-1)
+            per_minute, max_concurrent = domain_limits(domain)
+            if self.not_before.get(domain, 0) > now or not self.slots.take(domain, max_concurrent):
+                continue
+            wait = shared_state.try_acquire(f"domain:{domain}", per_minute / 60, min(DOMAIN_SEND_BURST, per_minute))
+            if wait:
+                self.slots.release(domain)
+                self.not_before[domain] = now + wait
+                continue
+
+            items = self.queues[domain]
+            item = items.popleft()
+            if not items:
+                del self.queues[domain]
+                self.rotation.remove(domain)
+            self.size -= 1
+            return item
+        return None
+
+    def wait_time(self):
+        """Seconds until a rate-limited domain may send again"""
+        now = time.monotonic()
+        waits = [self.not_before.get(domain, 0) - now for domain in self.queues]
+        return max(min(waits, default=0.0), 0.01)
+
+    def finished(self, message):
+        self.slots.release(domain_of(message[0].email))
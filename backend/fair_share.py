@@ -0,0 +1,67 @@
+"""
+Fair sharing of the sender process between tenants (users).
+Jobs run in time-boxed slices; which tenant gets the next free slot is decided
+by deficit round-robin, weighted by each tenant's send_weight, so a small
+campaign starts within one slice even while large ones are running.
+"""
+import os
+from collections import deque
+
+# Recipients and seconds a tenant's slice may use, times its send_weight
+SLICE_QUANTUM = int(os.getenv("SENDER_SLICE_QUANTUM", "100"))
+SLICE_SECONDS = float(os.getenv("SENDER_SLICE_SECONDS", "15"))
+# Slices one tenant may have running at once, unless users.max_concurrent_jobs says otherwise
+TENANT_MAX_SLICES = int(os.getenv("SENDER_TENANT_MAX_SLICES", "1"))
+
+
+class FairShareScheduler:
+    """
+    Deficit round-robin over tenants with runnable jobs.
+    Only used from the sender's scheduling thread.
+    """
+
+    def __init__(self, quantum=SLICE_QUANTUM):
+        self.quantum = quantum
+        self.deficit = {}
+        self.running = {}
+        self.order = deque()
+
+    def pick(self, jobs):
+        """
+        jobs: runnable (job_id, user_id, send_weight, max_slices), each tenant's
+        next job first. Returns (job_id, user_id, budget, seconds) for the next
+        slice, or None if every tenant with work is at its cap.
+        """
+        backlog = {}
+        for job_id, user_id, weight, max_slices in jobs:
+            backlog.setdefault(user_id, (job_id, weight or 1, max_slices or TENANT_MAX_SLICES))
+
+        # A tenant whose queue empties loses its credit, as in plain DRR
+        for user_id in list(self.deficit):
+            if user_id not in backlog and not self.running.get(user_id):
+                del self.deficit[user_id]
+        self.order = deque(u for u in self.order if u in backlog)
+        # Newcomers go first: they haven't had a slice this pass, and it keeps
+        # a small campaign from waiting behind every tenant already queued
+        arrived = [u for u in backlog if u not in self.order]
+        self.order.extendleft(reversed(arrived))
+
+        # Every tenant gets at least one quantum per pass, so this always
+        # finds someone unless all are capped
+        for _ in range(len(self.order)):
+            user_id = self.order[0]
+            self.order.rotate(-1)
+            job_id, weight, max_slices = backlog[user_id]
+            if self.running.get(user_id, 0) >= max_slices:
+                continue
+            budget = self.deficit.get(user_id, 0) + self.quantum * weight
+            self.deficit[user_id] = 0
+            self.running[user_id] = self.running.get(user_id, 0) + 1
+            return job_id, user_id, budget, SLICE_SECONDS * weight
+        return None
+
+    def finished(self, user_id, budget, used, weight=1):
+        """Return a slice's slot; unused budget carries over, up to one quantum"""
+        self.running[user_id] -= 1
+        if user_id in self.deficit:
+            self.deficit[user_id] = min(budget - used, self.quantum * (weight or 1))
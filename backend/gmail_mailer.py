@@ -1,17 +1,37 @@
 import os
 import base64
 import time
-import asyncio
+import queue
+import uuid
 import threading
+from concurrent.futures import ThreadPoolExecutor
+from email import encoders
+from email.mime.base import MIMEBase
+from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from google.oauth2.credentials import Credentials
-from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
+
+import shared_state
+from dispatcher import AccountDispatcher, http_status, is_account_error
+from domains import DomainScheduler
+from templating import get_compiled
+
+# Shared across workers: Gmail allows roughly 2.5 sends/second per user
+ACCOUNT_SENDS_PER_SECOND = float(os.getenv("ACCOUNT_SENDS_PER_SECOND", "2"))
+ACCOUNT_SEND_BURST = float(os.getenv("ACCOUNT_SEND_BURST", "8"))
+# Point the Gmail client at another server, e.g. a local fake for testing sync
+GMAIL_API_ROOT = os.getenv("GMAIL_API_ROOT")
+# Rendered messages a batch holds at most while waiting on domain limits
+SCHEDULER_LOOKAHEAD = int(os.getenv("SCHEDULER_LOOKAHEAD", "256"))
+
+# google-auth and googleapiclient are imported on first use: they are slow to
+# import and most requests a worker serves never touch the Gmail API.
 
 
 def refresh_access_token(refresh_token):
     """Refresh access token using refresh token"""
+    from google.oauth2.credentials import Credentials
+    from google.auth.transport.requests import Request
+
     try:
         creds = Credentials(
             token=None,
@@ -27,137 +47,300 @@ def refresh_access_token(refresh_token):
         raise
 
 
-def send_email_via_gmail(access_token, recipient_email, subject, body, sender_email, sender_name, delay=1):
-    """Send a single email via Gmail API"""
-    try:
-        creds = Credentials(token=access_token)
-        service = build("gmail", "v1", credentials=creds)
+def build_gmail_service(access_token):
+    """Build a Gmail API client for an access token"""
+    from google.oauth2.credentials import Credentials
+    from googleapiclient.discovery import build
 
-        message = MIMEText(body)
+    creds = Credentials(token=access_token)
+    client_options = {"api_endpoint": GMAIL_API_ROOT} if GMAIL_API_ROOT else None
+    return build("gmail", "v1", credentials=creds, cache_discovery=False, client_options=client_options)
+
+
+def build_body_part(body, html=None):
+    """Plain text part, or a text/HTML multipart/alternative when html is given"""
+    if html is None:
+        return MIMEText(body)
+    part = MIMEMultipart("alternative")
+    part.attach(MIMEText(body, "plain"))
+    part.attach(MIMEText(html, "html"))
+    return part
+
+
+def build_raw_message(recipient_email, subject, body, sender_email, sender_name, html=None):
+    """Encode a message into the base64url form the Gmail API expects"""
+    message = build_body_part(body, html)
+    message["to"] = recipient_email
+    # Format sender with name if available
+    if sender_name:
+        message["from"] = f"{sender_name} <{sender_email}>"
+    else:
+        message["from"] = sender_email
+    message["subject"] = subject
+    return base64.urlsafe_b64encode(message.as_bytes()).decode()
+
+
+class MessageBuilder:
+    """
+    Builds raw Gmail messages for one send job.
+    Attachment parts are MIME-encoded and base64url-encoded once; each
+    recipient's message only assembles its own headers and body, then
+    reuses the attachment bytes as-is.
+    attachments: list of tuples (filename, mime_type, content_bytes)
+    """
+
+    def __init__(self, attachments=()):
+        self.boundary = f"=_{uuid.uuid4().hex}"
+        self.encoded_tail = None
+        if attachments:
+            self.encoded_tail = base64.urlsafe_b64encode(self._attachment_tail(attachments)).decode()
+
+    def _attachment_tail(self, attachments):
+        delimiter = b"\n--" + self.boundary.encode() + b"\n"
+        parts = []
+        for filename, mime_type, content in attachments:
+            maintype, _, subtype = (mime_type or "application/octet-stream").partition("/")
+            part = MIMEBase(maintype, subtype or "octet-stream")
+            part.set_payload(content)
+            encoders.encode_base64(part)
+            part.add_header("Content-Disposition", "attachment", filename=filename)
+            parts.append(part.as_bytes())
+        return delimiter.join(parts) + b"\n--" + self.boundary.encode() + b"--\n"
+
+    def build(self, recipient_email, subject, body, sender_email, sender_name, html=None):
+        """Return the base64url raw message for one recipient"""
+        if self.encoded_tail is None:
+            return build_raw_message(recipient_email, subject, body, sender_email, sender_name, html)
+
+        message = MIMEMultipart("mixed", boundary=self.boundary)
         message["to"] = recipient_email
-        # Format sender with name if available
         if sender_name:
             message["from"] = f"{sender_name} <{sender_email}>"
         else:
             message["from"] = sender_email
         message["subject"] = subject
+        message.attach(build_body_part(body, html))
+
+        closing = b"--" + self.boundary.encode() + b"--\n"
+        head = message.as_bytes()
+        head = head[:head.rindex(closing)] + b"--" + self.boundary.encode()
+        # Transport padding after the delimiter keeps the head a multiple of
+        # 3 bytes, so its base64 joins the pre-encoded tail without re-encoding
+        head += b" " * (-(len(head) + 1) % 3) + b"\n"
+        return base64.urlsafe_b64encode(head).decode() + self.encoded_tail
 
-        raw_message = base64.urlsafe_b64encode(message.as_bytes()).decode()
-        send_message = {"raw": raw_message}
 
-        service.users().messages().send(userId="me", body=send_message).execute()
-        
+def send_email_via_gmail(access_token, recipient_email, subject, body, sender_email, sender_name, delay=1):
+    """Send a single email via Gmail API"""
+    try:
+        service = build_gmail_service(access_token)
+        raw_message = build_raw_message(recipient_email, subject, body, sender_email, sender_name)
+        service.users().messages().send(userId="me", body={"raw": raw_message}).execute()
+
         time.sleep(delay)
         return True
-    except HttpError as e:
-        if e.resp.status == 401:
+    except Exception as e:
+        status = http_status(e)
+        if status == 401:
             print(f"⚠️ Token expired for {sender_email}")
-            return False
-        else:
+        elif status:
             print(f"❌ Failed to send email to {recipient_email}: {str(e)}")
-            return False
-    except Exception as e:
-        print(f"❌ Gmail API Error: {str(e)}")
+        else:
+            print(f"❌ Gmail API Error: {str(e)}")
         return False
 
 
-def send_batch_via_gmail(sender_accounts, rows, subject, body, delay=0.5):
+class SenderAccount:
     """
-    Send emails in batches (max 200+ per account with optimized handling)
-    sender_accounts: list of tuples (account_id, email, access_token, refresh_token)
-    rows: list of recipient dicts
-    Uses threading for async batch processing to handle large batches efficiently
+    Token state for one sender account during a batch.
+    Gmail clients are not thread-safe, so each worker thread keeps its own.
+    Refreshed tokens and the send rate limit are shared with other workers.
     """
-    total_sent = [0]  # Use list to track in thread-safe manner
-    lock = threading.Lock()
-    account_index = 0
-    emails_per_account = 200  # Increased from 50 to 200
-    max_concurrent_per_account = 8  # Send up to 8 emails concurrently per account
-    
-    def send_email_worker(row, account_info):
-        """Worker function for threading"""
+    __slots__ = ("id", "email", "name", "access_token", "refresh_token", "_lock", "_local")
+
+    def __init__(self, account_id, email, name, access_token, refresh_token):
+        self.id = account_id
+        self.email = email
+        self.name = name
+        # Another worker may already hold a fresher token than the DB
+        self.access_token = shared_state.get_access_token(account_id) or access_token
+        self.refresh_token = refresh_token
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _service(self):
+        local = self._local
+        if getattr(local, "token", None) != self.access_token:
+            local.token = self.access_token
+            local.service = build_gmail_service(self.access_token)
+        return local.service
+
+    def _refresh(self, stale_token):
+        with self._lock:
+            # Another thread or worker may have refreshed already
+            if self.access_token != stale_token:
+                return
+            shared_token = shared_state.get_access_token(self.id)
+            if shared_token and shared_token != stale_token:
+                self.access_token = shared_token
+            elif self.refresh_token:
+                self.access_token = refresh_access_token(self.refresh_token)
+                shared_state.put_access_token(self.id, self.access_token)
+
+    def execute(self, make_request):
+        """Run make_request(service).execute(), refreshing the token once on 401"""
+        token = self.access_token
+        try:
+            return make_request(self._service()).execute()
+        except Exception as e:
+            if http_status(e) != 401:
+                raise
+            print(f"⚠️ Token expired for {self.email}, refreshing")
+            self._refresh(token)
+            return make_request(self._service()).execute()
+
+    def send(self, raw_message):
+        """Send an encoded message; returns Gmail's {"id", "threadId", ...}"""
+        shared_state.acquire(f"gmail:{self.id}", ACCOUNT_SENDS_PER_SECOND, ACCOUNT_SEND_BURST)
+        return self.execute(lambda service: service.users().messages().send(userId="me", body={"raw": raw_message}))
+
+
+def render_messages(recipients, template, on_error=None):
+    """Personalise a compiled template for each recipient, lazily"""
+    for recipient in recipients:
         try:
-            account_id, sender_email, sender_name, access_token, refresh_token = account_info
-            
-            if not row.get("email"):
-                return False
-            
-            personalized_subject = subject.format(**row)
-            personalized_body = body.format(**row)
-            
-            # Try sending with current token
-            success = send_email_via_gmail(
-                access_token,
-                row["email"],
-                personalized_subject,
-                personalized_body,
-                sender_email,
-                sender_name,
-                delay=0  # No delay needed with threading
+            yield (recipient, *template.render(recipient.fields()))
+        except (KeyError, IndexError, ValueError) as e:
+            print(f"⚠️ Skipping {recipient.email}: template error {str(e)}")
+            if on_error:
+                on_error(recipient, e)
+
+
+def send_batch_via_gmail(sender_accounts, recipients, subject, body, on_sent=None, max_concurrent_per_account=8,
+                         attachments=(), is_html=False, on_failed=None, usage=None, health=None, on_health=None,
+                         should_stop=None, domain_slots=None, message_builder=None):
+    """
+    Stream recipients through render -> encode -> send -> log.
+    sender_accounts: list of tuples (account_id, email, name, access_token, refresh_token)
+    recipients: iterable of Recipient records, consumed lazily
+    on_sent: optional callback(recipient, account_id, sent), invoked from the calling thread;
+    sent is Gmail's response with the message "id" and "threadId"
+    on_failed: optional callback(recipient, account_id, error), invoked from the calling thread;
+    account_id is None when the template couldn't be rendered for the recipient
+    attachments: list of tuples (filename, mime_type, content_bytes), encoded once for the batch
+    message_builder: optional MessageBuilder with the attachments already encoded,
+    e.g. reused across a job's slices; used instead of attachments
+    is_html: treat body as HTML and send it with a generated text alternative
+    usage, health, on_health: account quota and breaker state, see AccountDispatcher
+    should_stop: optional callable; once it returns True no new sends start, and
+    recipients already read but not sent are left to the caller to requeue
+    domain_slots: optional DomainSlots shared with batches running alongside this
+    one, so per-domain concurrency holds across them; by default this batch's own
+    At most max_concurrent_per_account sends are in flight per account, so
+    memory stays flat regardless of list size. Recipients are interleaved
+    across their domains within the limits in domains.py. Recipients whose send failed
+    because of the account (auth, quota, throttling) are re-routed to another
+    account rather than reported as failed. Raises AccountsUnavailable (after
+    in-flight sends finish) once no account can send.
+    """
+    accounts = [SenderAccount(*a) for a in sender_accounts]
+    dispatcher = AccountDispatcher(accounts, usage, max_concurrent_per_account, health, on_health)
+    builder = MessageBuilder(attachments) if message_builder is None else message_builder
+    template = get_compiled(subject, body, is_html)
+    limit = max_concurrent_per_account * len(accounts)
+    messages = render_messages(recipients, template, on_error=on_failed and (lambda r, e: on_failed(r, None, e)))
+    # Rendered messages waiting per recipient domain, each with the ids of
+    # accounts that already failed it
+    scheduler = DomainScheduler(domain_slots)
+    exhausted = False
+    done = queue.Queue()
+    in_flight = 0
+    total_sent = 0
+
+    def send_worker(account, recipient, personalized_subject, personalized_body, personalized_html):
+        """Encode and send one message; runs on a pool thread. Returns (error, seconds, sent)"""
+        started = time.monotonic()
+        try:
+            raw_message = builder.build(
+                recipient.email, personalized_subject, personalized_body, account.email, account.name,
+                personalized_html,
             )
-            
-            if success:
-                return True
-            else:
-                # Try refreshing token
+            sent = account.send(raw_message)
+            return None, time.monotonic() - started, sent or {}
+        except Exception as e:
+            print(f"❌ Failed to send email to {recipient.email} from {account.email}: {str(e)}")
+            return e, time.monotonic() - started, None
+
+    def collect(timeout=None):
+        nonlocal in_flight, total_sent
+        try:
+            message, tried, account, future = done.get(timeout=timeout)
+        except queue.Empty:
+            return
+        recipient = message[0]
+        in_flight -= 1
+        scheduler.finished(message)
+        error, elapsed, sent = future.result()
+        dispatcher.finished(account, error is None, elapsed, error)
+        if error is None:
+            total_sent += 1
+            if on_sent:
+                on_sent(recipient, account.id, sent)
+        elif is_account_error(error):
+            scheduler.add(message, tried | {account.id}, front=True)
+        elif on_failed:
+            on_failed(recipient, account.id, error)
+
+    with ThreadPoolExecutor(max_workers=limit) as pool:
+        try:
+            while not (should_stop and should_stop()):
+                # Read ahead so other domains can send while some wait for their limit
+                while not exhausted and scheduler.size < SCHEDULER_LOOKAHEAD:
+                    message = next(messages, None)
+                    if message is None:
+                        exhausted = True
+                    else:
+                        scheduler.add(message)
+                if not scheduler.size:
+                    if not in_flight:
+                        break
+                    collect()
+                    continue
+
+                # Backpressure: stop reading rows until an account can take the send
+                if not dispatcher.has_capacity():
+                    if in_flight:
+                        collect()
+                    else:
+                        time.sleep(min(dispatcher.wait_time(), 1.0))
+                    continue
+
+                item = scheduler.next_ready()
+                if item is None:
+                    # Every waiting domain is at its concurrency or rate limit
+                    if in_flight:
+                        collect(timeout=scheduler.wait_time())
+                    else:
+                        time.sleep(min(scheduler.wait_time(), 1.0))
+                    continue
+
+                message, tried = item
+                account = dispatcher.pick(avoid=tried)
+                future = pool.submit(send_worker, account, *message)
+                future.add_done_callback(lambda f, m=message, t=tried, a=account: done.put((m, t, a, f)))
+                in_flight += 1
+        finally:
+            # Sends in flight have gone out whatever happened above, so each
+            # must still reach its callback, even after another one raised;
+            # the caller would otherwise requeue and resend it
+            callback_error = None
+            while in_flight:
                 try:
-                    new_token = refresh_access_token(refresh_token)
-                    success = send_email_via_gmail(
-                        new_token,
-                        row["email"],
-                        personalized_subject,
-                        personalized_body,
-                        sender_email,
-                        sender_name,
-                        delay=0
-                    )
-                    return success
+                    collect()
                 except Exception as e:
-                    print(f"⚠️ Token refresh failed for {sender_email}: {str(e)}")
-                    return False
-        except Exception as e:
-            print(f"⚠️ Worker error: {str(e)}")
-            return False
-    
-    # Process emails in batches using account rotation
-    active_threads = []
-    thread_results = []
-    
-    for row_index, row in enumerate(rows):
-        if not row.get("email"):
-            continue
-        
-        # Rotate through accounts
-        account_index = (row_index // max_concurrent_per_account) % len(sender_accounts)
-        account_info = sender_accounts[account_index]
-        
-        # Wait for some threads to complete if we have too many
-        if len(active_threads) >= max_concurrent_per_account * len(sender_accounts):
-            # Wait for at least one thread to complete
-            for i, (thread, result_list) in enumerate(active_threads[:]):
-                thread.join(timeout=3)
-                if not thread.is_alive():
-                    # Count result if available
-                    if result_list and result_list[0]:
-                        with lock:
-                            total_sent[0] += 1
-                    active_threads.pop(i)
-                    break
-        
-        # Create and start thread
-        result_list = []
-        thread = threading.Thread(
-            target=lambda r=row, a=account_info, res=result_list: res.append(send_email_worker(r, a)),
-            daemon=True
-        )
-        thread.start()
-        active_threads.append((thread, result_list))
-    
-    # Wait for all threads to complete
-    for thread, result_list in active_threads:
-        thread.join(timeout=5)
-        if result_list and result_list[0]:
-            with lock:
-                total_sent[0] += 1
-    
-    return total_sent[0]
+                    callback_error = callback_error or e
+            dispatcher.report()
+            if callback_error is not None:
+                raise callback_error
+
+    return total_sent
@@ -0,0 +1,61 @@
+"""Gunicorn server hooks; worker settings stay on the Procfile command line"""
+import os
+import subprocess
+import sys
+import threading
+import time
+
+# Set RUN_SENDER=0 when sender.py runs as its own service instead
+RUN_SENDER = os.getenv("RUN_SENDER", "1") == "1"
+# How long the sender gets to finish in-flight sends on shutdown
+SENDER_DRAIN_SECONDS = int(os.getenv("SENDER_DRAIN_SECONDS", "25"))
+
+_sender = {"process": None, "stopping": False}
+
+
+def on_starting(server):
+    # Runs once in the master before any worker is forked, so workers only
+    # do a cheap schema version check instead of running DDL on import.
+    # migrations opens and closes its own connection; no handle is inherited.
+    from migrations import migrate
+    migrate()
+
+
+def _supervise_sender(server):
+    """Keep one sender.py process running for the master's lifetime"""
+    backoff = 1
+    while not _sender["stopping"]:
+        started = time.monotonic()
+        process = subprocess.Popen(
+            [sys.executable, "sender.py"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        )
+        _sender["process"] = process
+        code = process.wait()
+        if _sender["stopping"]:
+            return
+        # Back off if it keeps crashing right after start
+        backoff = 1 if time.monotonic() - started > 60 else min(backoff * 2, 30)
+        server.log.warning(f"Sender process exited with code {code}; restarting in {backoff}s")
+        time.sleep(backoff)
+        # The sender may have seen a group-wide SIGTERM before on_exit ran
+        if _sender["stopping"]:
+            return
+
+
+def when_ready(server):
+    # The sender belongs to the master, so worker timeouts and recycling
+    # (max_requests, HUP) never touch running send jobs
+    if RUN_SENDER:
+        threading.Thread(target=_supervise_sender, args=(server,), daemon=True).start()
+
+
+def on_exit(server):
+    _sender["stopping"] = True
+    process = _sender["process"]
+    if process and process.poll() is None:
+        process.terminate()  # SIGTERM: sender drains and checkpoints
+        try:
+            process.wait(timeout=SENDER_DRAIN_SECONDS)
+        except subprocess.TimeoutExpired:
+            process.kill()
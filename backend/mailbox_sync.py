@@ -0,0 +1,134 @@
+"""
+Incremental reply and bounce detection for sender accounts.
+Each account's Gmail history id is stored after every sync, so a sync only
+fetches the mailbox changes since the last one instead of rescanning it.
+New messages are matched to campaigns by the thread ids stored when sending.
+
+The sender process runs this every MAILBOX_SYNC_INTERVAL seconds; it can also
+be run once directly with: python mailbox_sync.py
+"""
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from db import (
+    get_sync_accounts,
+    set_history_id,
+    find_sent_by_thread,
+    find_sent_to,
+    record_mailbox_event,
+)
+from dispatcher import http_status
+from gmail_mailer import SenderAccount
+
+# Seconds between syncs in the sender process; 0 turns syncing off
+MAILBOX_SYNC_INTERVAL = float(os.getenv("MAILBOX_SYNC_INTERVAL", "300"))
+HISTORY_PAGE_SIZE = 500
+
+BOUNCE_SENDERS = ("mailer-daemon@", "postmaster@")
+
+
+def message_headers(message):
+    return {h["name"].lower(): h["value"] for h in message.get("payload", {}).get("headers", [])}
+
+
+def is_bounce(headers):
+    sender = headers.get("from", "").lower()
+    return "x-failed-recipients" in headers or any(s in sender for s in BOUNCE_SENDERS)
+
+
+def added_messages(account, start_history_id):
+    """
+    Messages added to the mailbox since start_history_id, other than the
+    account's own sends. Returns ({message_id: thread_id}, latest history id).
+    """
+    messages = {}
+    page_token = None
+    while True:
+        response = account.execute(lambda service: service.users().history().list(
+            userId="me",
+            startHistoryId=start_history_id,
+            historyTypes=["messageAdded"],
+            maxResults=HISTORY_PAGE_SIZE,
+            pageToken=page_token,
+        ))
+        for record in response.get("history", []):
+            for added in record.get("messagesAdded", []):
+                message = added["message"]
+                if "SENT" not in message.get("labelIds", []):
+                    messages[message["id"]] = message["threadId"]
+        page_token = response.get("nextPageToken")
+        if not page_token:
+            return messages, response.get("historyId", start_history_id)
+
+
+def reset_history(account):
+    """Start tracking from the mailbox's current state; older mail isn't scanned"""
+    profile = account.execute(lambda service: service.users().getProfile(userId="me"))
+    set_history_id(account.id, profile["historyId"])
+
+
+def sync_account(account_row):
+    """Record replies and bounces that arrived since the last sync; returns how many"""
+    account_id, user_id, email, name, access_token, refresh_token, history_id = account_row
+    account = SenderAccount(account_id, email, name, access_token, refresh_token)
+    if not history_id:
+        reset_history(account)
+        return 0
+
+    try:
+        messages, latest_history_id = added_messages(account, history_id)
+    except Exception as e:
+        # Gmail only keeps about a week of history
+        if http_status(e) != 404:
+            raise
+        print(f"⚠️ History for {email} expired; syncing from now on")
+        reset_history(account)
+        return 0
+
+    sent_by_thread = find_sent_by_thread(account_id, set(messages.values()))
+    events = 0
+    for message_id, thread_id in messages.items():
+        sent = sent_by_thread.get(thread_id)
+        # Only messages in threads a campaign started are fetched
+        if not sent:
+            continue
+        message = account.execute(lambda service: service.users().messages().get(
+            userId="me", id=message_id, format="metadata", metadataHeaders=["From", "X-Failed-Recipients"],
+        ))
+        headers = message_headers(message)
+        sent_id, recipient_email = sent
+        if is_bounce(headers):
+            failed = headers.get("x-failed-recipients", "").split(",")[0].strip()
+            if failed and failed.lower() != recipient_email.lower():
+                sent_id = find_sent_to(account_id, failed) or sent_id
+            kind = "bounce"
+        else:
+            kind = "reply"
+        if record_mailbox_event(sent_id, kind):
+            events += 1
+
+    set_history_id(account_id, latest_history_id)
+    return events
+
+
+def sync_all_accounts():
+    """Sync every connected account; one failing account doesn't stop the rest"""
+    total = 0
+    for account_row in get_sync_accounts():
+        try:
+            total += sync_account(account_row)
+        except Exception as e:
+            print(f"❌ Mailbox sync failed for {account_row[2]}: {str(e)}")
+    if total:
+        print(f"📬 Mailbox sync recorded {total} replies/bounces")
+    return total
+
+
+if __name__ == "__main__":
+    from migrations import ensure_schema
+
+    ensure_schema()
+    sync_all_accounts()
@@ -1,39 +1,65 @@
+import time
+
+# Worker cold-start timing, reported once per process
+_import_started = time.perf_counter()
+
+import csv
+import io
+import json
 import os
-import asyncio
-from concurrent.futures import ThreadPoolExecutor
+import sys
+import uuid
+from datetime import datetime, timezone
 from dotenv import load_dotenv
 
 # Load env first
 load_dotenv()
 
 from fastapi import FastAPI, Request, UploadFile
-from fastapi.responses import RedirectResponse, JSONResponse, HTMLResponse
+from fastapi.responses import RedirectResponse, JSONResponse, HTMLResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from starlette.requests import Request as StarletteRequest
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.middleware.sessions import SessionMiddleware
 
 from auth import oauth_client
-from gmail_mailer import send_batch_via_gmail
+from migrations import ensure_schema
+from csv_store import content_hash
+from dispatcher import ACCOUNT_DAILY_LIMIT
+import async_db
+import shared_state
+# segments (pandas/numpy) is imported by the handlers that filter rows, on
+# first use, so workers that never filter don't pay for it
+from templating import LRUCache, get_compiled, template_hash
 from db import (
-    get_or_create_user,
-    save_csv,
     get_csvs,
-    get_csv_content,
+    iter_csv_content,
+    get_csv_info,
+    get_csv_rows,
+    get_segments,
+    get_segment,
+    delete_segment,
+    get_send_job,
+    get_dead_letters,
+    get_suppressions,
+    delete_suppression,
     count_total_emails_sent,
+    iter_sent_history,
     count_total_csvs,
-    create_session,
     get_session,
     delete_session,
-    log_email_sent,
     delete_csv,
-    add_gmail_account,
     get_gmail_accounts,
-    get_gmail_account,
-    count_gmail_accounts,
     delete_gmail_account,
-    update_gmail_account_name,
-    update_user_gmail_tokens,
+    get_account_usage,
+    get_account_health,
     get_user_gmail_tokens,
+    get_attachments,
+    delete_attachment,
+    get_templates,
+    get_template,
+    get_template_versions,
+    delete_template,
 )
 
 # ================== ENV CHECK ==================
@@ -41,13 +67,58 @@ assert os.getenv("GOOGLE_CLIENT_ID")
 assert os.getenv("GOOGLE_CLIENT_SECRET")
 assert os.getenv("SESSION_SECRET")
 
+# Gmail rejects raw messages much over 5 MB once base64-encoded
+MAX_ATTACHMENT_BYTES = 3 * 1024 * 1024
+
+# Row previews are rendered once per (csv, row, template content)
+PREVIEW_CACHE_SIZE = 2048
+MAX_PAGE_SIZE = 500
+# Matching rows returned with a filter preview
+SEGMENT_SAMPLE_SIZE = 20
+# Rows written to the send history export per chunk
+EXPORT_CHUNK_ROWS = 500
+
 # Set FRONTEND_URL based on environment
 FRONTEND_URL = os.getenv("FRONTEND_URL", "http://localhost:3000")
 
 app = FastAPI()
 
-# Create thread pool executor for background tasks
-executor = ThreadPoolExecutor(max_workers=10)
+preview_cache = LRUCache(PREVIEW_CACHE_SIZE)
+
+
+@app.on_event("startup")
+def check_schema():
+    # Normally a no-op: gunicorn.conf.py migrates once before workers fork
+    ensure_schema()
+    print(f"⏱️ Worker {os.getpid()} ready {(time.perf_counter() - _import_started) * 1000:.0f} ms after import started")
+
+
+class FirstRequestTimer:
+    """
+    Pure ASGI middleware that reports when the worker answers its first
+    request. Afterwards it is a single flag check: it doesn't wrap send, so
+    streaming responses pass through untouched.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.reported = False
+
+    async def __call__(self, scope, receive, send):
+        if self.reported or scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        self.reported = True
+
+        async def send_and_report(message):
+            await send(message)
+            if message["type"] == "http.response.start":
+                print(f"⏱️ Worker {os.getpid()} served first request {(time.perf_counter() - _import_started) * 1000:.0f} ms after import started")
+
+        await self.app(scope, receive, send_and_report)
+
+
+app.add_middleware(FirstRequestTimer)
+
 
 # ================== SESSION ==================
 # Detect if we're on production (HTTPS) or local (HTTP)
@@ -86,7 +157,7 @@ async def google_callback(request: Request):
     token = await google.authorize_access_token(request)
     user = token["userinfo"]
 
-    user_id = get_or_create_user(
+    user_id = await async_db.get_or_create_user(
         user["sub"],
         user["email"],
         user["name"],
@@ -96,9 +167,9 @@ async def google_callback(request: Request):
     access_token = token.get("access_token")
     refresh_token = token.get("refresh_token")
     if access_token:
-        update_user_gmail_tokens(user_id, access_token, refresh_token)
+        await async_db.update_user_gmail_tokens(user_id, access_token, refresh_token)
 
-    session_id = create_session(user_id, {
+    session_id = await async_db.create_session(user_id, {
         "id": user_id,
         "email": user["email"],
         "name": user["name"],
@@ -160,13 +231,363 @@ def logout(request: Request):
 @app.post("/upload-csv")
 async def upload_csv(file: UploadFile, request: Request):
     session_id = request.cookies.get("session_id")
-    user = get_session(session_id) if session_id else None
+    user = await async_db.get_session(session_id) if session_id else None
     if not user:
         return JSONResponse({"error": "Unauthorized"}, status_code=401)
 
+    data = await file.read()
+    digest = content_hash(data)
+
+    # Identical re-uploads (e.g. before every send) reuse the stored list
+    csv_id = await async_db.find_csv_by_hash(user["id"], digest)
+    if csv_id:
+        return {"csv_id": csv_id, "filename": file.filename, "deduplicated": True}
+
+    csv_id = await async_db.save_csv(user["id"], file.filename, data.decode("utf-8"), digest)
+    return {"csv_id": csv_id, "filename": file.filename, "deduplicated": False}
+
+
+@app.post("/csvs/{csv_id}/append")
+async def append_csv_api(csv_id: int, file: UploadFile, request: Request):
+    """Add only the rows of an uploaded CSV that the stored list doesn't have yet"""
+    session_id = request.cookies.get("session_id")
+    user = await async_db.get_session(session_id) if session_id else None
+    if not user:
+        return JSONResponse({"error": "Unauthorized"}, status_code=401)
+
+    info = await async_db.get_csv_info(csv_id, user["id"])
+    if not info:
+        return JSONResponse({"error": "Not found"}, status_code=404)
+
     content = (await file.read()).decode("utf-8")
-    csv_id = save_csv(user["id"], file.filename, content)
-    return {"csv_id": csv_id, "filename": file.filename}
+    added = await async_db.append_csv(csv_id, user["id"], content)
+    if added is None:
+        return JSONResponse({"error": "CSV headers don't match the existing list"}, status_code=400)
+
+    return {"csv_id": csv_id, "added": added, "rowCount": info[1] + added}
+
+
+@app.get("/csvs/{csv_id}/rows")
+def list_csv_rows(csv_id: int, request: Request, cursor: int = None, offset: int = 0, limit: int = 50):
+    """Page through stored rows; pass nextCursor back as cursor for the next page"""
+    session_id = request.cookies.get("session_id")
+    user = get_session(session_id) if session_id else None
+    if not user:
+        return JSONResponse({"error": "Unauthorized"}, status_code=401)
+
+    info = get_csv_info(csv_id, user["id"])
+    if not info:
+        return JSONResponse({"error": "Not found"}, status_code=404)
+    headers, row_count = info
+
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    # Row indexes are dense, so an offset is just a keyset position
+    after = cursor if cursor is not None else offset - 1
+    rows = get_csv_rows(csv_id, after, limit)
+
+    return {
+        "headers": list(headers),
+        "total": row_count,
+        "rows": [{"index": i, "values": values} for i, values in rows],
+        "nextCursor": rows[-1][0] if len(rows) == limit else None,
+    }
+
+
+@app.post("/csvs/{csv_id}/preview")
+async def csv_preview(csv_id: int, request: Request):
+    """Render subject/body of a template for one row"""
+    session_id = request.cookies.get("session_id")
+    user = await async_db.get_session(session_id) if session_id else None
+    if not user:
+        return JSONResponse({"error": "Unauthorized"}, status_code=401)
+
+    info = await async_db.get_csv_info(csv_id, user["id"])
+    if not info:
+        return JSONResponse({"error": "Not found"}, status_code=404)
+    headers, _ = info
+
+    body = await request.json()
+    row_index = int(body.get("rowIndex", 0))
+    if body.get("templateId"):
+        saved = await async_db.get_template(body["templateId"], user["id"])
+        if not saved:
+            return JSONResponse({"error": "Template not found"}, status_code=404)
+        subject, template_body, is_html = saved[3], saved[4], bool(saved[5])
+    else:
+        template = body.get("template") or {}
+        subject = template.get("subject", "")
+        template_body = template.get("body", "")
+        is_html = bool(template.get("isHtml", False))
+
+    key = (csv_id, row_index, template_hash(subject, template_body, is_html))
+    preview = preview_cache.get(key)
+    if preview is None:
+        values = await async_db.get_csv_row(csv_id, row_index)
+        if values is None:
+            return JSONResponse({"error": "Row not found"}, status_code=404)
+
+        fields = dict(zip(headers, values))
+        try:
+            rendered_subject, text, html = get_compiled(subject, template_body, is_html).render(fields)
+        except (KeyError, IndexError, ValueError) as e:
+            return JSONResponse({"error": f"Template error: {str(e)}"}, status_code=400)
+
+        preview = {
+            "rowIndex": row_index,
+            "subject": rendered_subject,
+            "body": text,
+            "html": html,
+        }
+        preview_cache.put(key, preview)
+
+    return preview
+
+
+# ================== SEGMENTS ==================
+
+def segment_json(s, count=None):
+    segment = {"id": s[0], "csvId": s[1], "name": s[2], "filter": s[3], "createdAt": s[4]}
+    if count is not None:
+        segment["count"] = count
+    return segment
+
+
+@app.post("/csvs/{csv_id}/filter")
+async def filter_csv(csv_id: int, request: Request):
+    """Count the rows a filter matches and return the first few"""
+    session_id = request.cookies.get("session_id")
+    user = await async_db.get_session(session_id) if session_id else None
+    if not user:
+        return JSONResponse({"error": "Unauthorized"}, status_code=401)
+
+    info = await async_db.get_csv_info(csv_id, user["id"])
+    if not info:
+        return JSONResponse({"error": "Not found"}, status_code=404)
+    headers, row_count = info
+
+    body = await request.json()
+    from segments import FilterError, matching_rows
+
+    try:
+        # Pandas work; kept off both the event loop and the DB thread
+        rows = await run_in_threadpool(matching_rows, csv_id, headers, row_count, body.get("filter", ""))
+    except FilterError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+
+    return {
+        "count": len(rows),
+        "total": row_count,
+        "rows": [
+            {"index": int(i), "values": await async_db.get_csv_row(csv_id, int(i))}
+            for i in rows[:SEGMENT_SAMPLE_SIZE]
+        ],
+    }
+
+
+@app.post("/segments")
+async def create_segment(request: Request):
+    """Save a named filter over a CSV; pass segmentId to /send-emails to target it"""
+    session_id = request.cookies.get("session_id")
+    user = await async_db.get_session(session_id) if session_id else None
+    if not user:
+        return JSONResponse({"error": "Unauthorized"}, status_code=401)
+
+    body = await request.json()
+    csv_id = body.get("csvId")
+    name = (body.get("name") or "").strip()
+    filter_expression = body.get("filter", "")
+    if not name:
+        return JSONResponse({"error": "Name is required"}, status_code=400)
+
+    info = await async_db.get_csv_info(csv_id, user["id"])
+    if not info:
+        return JSONResponse({"error": "CSV not found"}, status_code=404)
+    headers, row_count = info
+
+    from segments import FilterError, matching_rows
+
+    try:
+        rows = await run_in_threadpool(matching_rows, csv_id, headers, row_count, filter_expression)
+    except FilterError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+
+    segment_id = await async_db.save_segment(user["id"], csv_id, name, filter_expression)
+    return segment_json(await async_db.get_segment(segment_id, user["id"]), len(rows))
+
+
+@app.get("/segments")
+def list_segments(request: Request, csvId: int = None):
+    session_id = request.cookies.get("session_id")
+    user = get_session(session_id) if session_id else None
+    if not user:
+        return JSONResponse({"error": "Unauthorized"}, status_code=401)
+
+    return {"segments": [segment_json(s) for s in get_segments(user["id"], csvId)]}
+
+
+@app.get("/segments/{segment_id}")
+def segment_details(segment_id: int, request: Request):
+    """A segment with the number of rows it matches now"""
+    session_id = request.cookies.get("session_id")
+    user = get_session(session_id) if session_id else None
+    if not user:
+        return JSONResponse({"error": "Unauthorized"}, status_code=401)
+
+    segment = get_segment(segment_id, user["id"])
+    info = get_csv_info(segment[1], user["id"]) if segment else None
+    if not info:
+        return JSONResponse({"error": "Not found"}, status_code=404)
+
+    from segments import FilterError, matching_rows
+
+    try:
+        rows = matching_rows(segment[1], info[0], info[1], segment[3])
+    except FilterError as e:
+        # The filter no longer fits the CSV's columns
+        return JSONResponse({"error": str(e)}, status_code=400)
+    return segment_json(segment, len(rows))
+
+
+@app.delete("/segments/{segment_id}")
+def delete_segment_api(segment_id: int, request: Request):
+    session_id = request.cookies.get("session_id")
+    user = get_session(session_id) if session_id else None
+    if not user:
+        return JSONResponse({"error": "Unauthorized"}, status_code=401)
+
+    delete_segment(segment_id, user["id"])
+    return {"success": True}
+
+
+# ================== ATTACHMENTS ==================
+
+@app.post("/attachments")
+async def upload_attachment(file: UploadFile, request: Request):
+    session_id = request.cookies.get("session_id")
+    user = await async_db.get_session(session_id) if session_id else None
+    if not user:
+        return JSONResponse({"error": "Unauthorized"}, status_code=401)
+
+    content = await file.read()
+    if not content:
+        return JSONResponse({"error": "Empty file"}, status_code=400)
+    if len(content) > MAX_ATTACHMENT_BYTES:
+        return JSONResponse({"error": "Attachment too large (max 3 MB)"}, status_code=400)
+
+    attachment_id = await async_db.save_attachment(
+        user["id"],
+        file.filename,
+        file.content_type or "application/octet-stream",
+        content,
+    )
+    return {"attachment_id": attachment_id, "filename": file.filename}
+
+
+@app.get("/attachments")
+def list_attachments(request: Request):
+    session_id = request.cookies.get("session_id")
+    user = get_session(session_id) if session_id else None
+    if not user:
+        return JSONResponse({"error": "Unauthorized"}, status_code=401)
+
+    return {
+        "attachments": [
+            {
+                "id": a[0],
+                "filename": a[1],
+                "mimeType": a[2],
+                "size": a[3],
+                "uploadedAt": a[4],
+            }
+            for a in get_attachments(user["id"])
+        ]
+    }
+
+
+@app.delete("/attachments/{attachment_id}")
+def delete_attachment_api(attachment_id: int, request: Request):
+    session_id = request.cookies.get("session_id")
+    user = get_session(session_id) if session_id else None
+    if not user:
+        return JSONResponse({"error": "Unauthorized"}, status_code=401)
+
+    if not delete_attachment(attachment_id, user["id"]):
+        return JSONResponse({"error": "Attachment is used by a campaign that is still sending"}, status_code=409)
+    return {"success": True}
+
+
+# ================== TEMPLATES ==================
+
+def template_json(t):
+    return {
+        "id": t[0],
+        "name": t[1],
+        "version": t[2],
+        "subject": t[3],
+        "body": t[4],
+        "isHtml": bool(t[5]),
+        "createdAt": t[6],
+    }
+
+
+@app.get("/templates")
+def list_templates(request: Request):
+    session_id = request.cookies.get("session_id")
+    user = get_session(session_id) if session_id else None
+    if not user:
+        return JSONResponse({"error": "Unauthorized"}, status_code=401)
+
+    return {"templates": [template_json(t) for t in get_templates(user["id"])]}
+
+
+@app.post("/templates")
+async def create_template(request: Request):
+    """Save a template; saving an existing name creates a new version"""
+    session_id = request.cookies.get("session_id")
+    user = await async_db.get_session(session_id) if session_id else None
+    if not user:
+        return JSONResponse({"error": "Unauthorized"}, status_code=401)
+
+    body = await request.json()
+    name = (body.get("name") or "Untitled").strip()
+    subject = body.get("subject", "")
+    template_body = body.get("body", "")
+    if not subject or not template_body:
+        return JSONResponse({"error": "Subject and body are required"}, status_code=400)
+
+    template_id = await async_db.save_template(user["id"], name, subject, template_body, body.get("isHtml", False))
+    return template_json(await async_db.get_template(template_id, user["id"]))
+
+
+@app.get("/templates/{template_id}")
+def get_template_api(template_id: int, request: Request):
+    session_id = request.cookies.get("session_id")
+    user = get_session(session_id) if session_id else None
+    if not user:
+        return JSONResponse({"error": "Unauthorized"}, status_code=401)
+
+    template = get_template(template_id, user["id"])
+    if not template:
+        return JSONResponse({"error": "Not found"}, status_code=404)
+
+    return {
+        **template_json(template),
+        "versions": [template_json(t) for t in get_template_versions(user["id"], template[1])],
+    }
+
+
+@app.delete("/templates/{template_id}")
+def delete_template_api(template_id: int, request: Request):
+    """Delete a template and all of its versions"""
+    session_id = request.cookies.get("session_id")
+    user = get_session(session_id) if session_id else None
+    if not user:
+        return JSONResponse({"error": "Unauthorized"}, status_code=401)
+
+    template = get_template(template_id, user["id"])
+    if template:
+        delete_template(user["id"], template[1])
+    return {"success": True}
 
 
 # ================== DASHBOARD ==================
@@ -202,15 +623,12 @@ def download_csv(csv_id: int, request: Request):
     if not user:
         return JSONResponse({"error": "Unauthorized"}, status_code=401)
 
-    content = get_csv_content(csv_id, user["id"])
-    if not content:
+    if not get_csv_info(csv_id, user["id"]):
         return JSONResponse({"error": "Not found"}, status_code=404)
 
-    from fastapi.responses import StreamingResponse
-    from io import BytesIO
-
+    # Decompressed chunk by chunk, so the whole file is never held in memory
     return StreamingResponse(
-        BytesIO(content.encode()),
+        iter_csv_content(csv_id),
         media_type="text/csv",
         headers={"Content-Disposition": "attachment; filename=export.csv"},
     )
@@ -224,6 +642,9 @@ def delete_csv_api(csv_id: int, request: Request):
         return JSONResponse({"error": "Unauthorized"}, status_code=401)
 
     delete_csv(csv_id, user["id"])
+    # Only a worker that has run a filter has frames to drop
+    if "segments" in sys.modules:
+        sys.modules["segments"].frame_cache.discard(csv_id)
     return {"success": True}
 
 
@@ -231,9 +652,9 @@ def delete_csv_api(csv_id: int, request: Request):
 
 @app.post("/send-emails")
 async def send_emails(request: Request):
-    """Send emails asynchronously to support large batches (up to 200+)"""
+    """Queue a send job; poll /send-jobs/{jobId} for progress"""
     session_id = request.cookies.get("session_id")
-    user = get_session(session_id) if session_id else None
+    user = await async_db.get_session(session_id) if session_id else None
     if not user:
         return JSONResponse({"error": "Unauthorized"}, status_code=401)
 
@@ -241,48 +662,80 @@ async def send_emails(request: Request):
         body = await request.json()
         csv_id = body["csvId"]
         sender_account_ids = body["senderAccountIds"]  # List of Gmail account IDs to use
-        template = body["template"]
+        if body.get("templateId"):
+            saved = await async_db.get_template(body["templateId"], user["id"])
+            if not saved:
+                return JSONResponse({"error": "Template not found"}, status_code=404)
+            template = {"subject": saved[3], "body": saved[4], "isHtml": bool(saved[5])}
+        else:
+            template = body["template"]
 
         if not sender_account_ids:
             return JSONResponse({"error": "No sender accounts selected"}, status_code=400)
 
-        # Get CSV content
-        csv_content = get_csv_content(csv_id, user["id"])
-        if not csv_content:
+        csv_info = await async_db.get_csv_info(csv_id, user["id"])
+        if not csv_info:
             return JSONResponse({"error": "CSV not found"}, status_code=404)
-
-        lines = csv_content.strip().splitlines()
-        headers = lines[0].split(",")
-        rows = [dict(zip(headers, r.split(","))) for r in lines[1:] if r.strip()]
-
-        # Get sender account details
-        sender_accounts = []
+        csv_headers, row_count = csv_info
+        if "email" not in csv_headers:
+            return JSONResponse({"error": "CSV has no email column"}, status_code=400)
+
+        # Optionally only the rows of a saved segment or an ad hoc filter
+        segment_id = body.get("segmentId")
+        filter_expression = body.get("filter")
+        if segment_id:
+            segment = await async_db.get_segment(segment_id, user["id"])
+            if not segment or segment[1] != csv_id:
+                return JSONResponse({"error": "Segment not found"}, status_code=404)
+            filter_expression = segment[3]
+        row_indexes = None
+        if filter_expression:
+            from segments import FilterError, matching_rows
+
+            try:
+                rows = await run_in_threadpool(matching_rows, csv_id, csv_headers, row_count, filter_expression)
+            except FilterError as e:
+                return JSONResponse({"error": str(e)}, status_code=400)
+            if not len(rows):
+                return JSONResponse({"error": "No rows match the filter"}, status_code=400)
+            row_indexes = rows.tolist()
+
+        # Only accounts the user owns are queued
+        owned_account_ids = []
         for account_id in sender_account_ids:
-            account = get_gmail_account(account_id, user["id"])
-            if account:
-                # Extract the needed fields: (id, email, name, access_token, refresh_token)
-                account_id, gmail_id, email, name, access_token, refresh_token = account
-                sender_accounts.append((account_id, email, name, access_token, refresh_token))
-
-        if not sender_accounts:
+            if await async_db.get_gmail_account(account_id, user["id"]):
+                owned_account_ids.append(account_id)
+        sender_account_ids = owned_account_ids
+        if not sender_account_ids:
             return JSONResponse({"error": "Invalid sender accounts"}, status_code=400)
 
-        # Run email sending in background thread to avoid timeout
-        loop = asyncio.get_event_loop()
-        sent = await loop.run_in_executor(
-            executor,
-            send_batch_via_gmail,
-            sender_accounts,
-            rows,
+        attachment_ids = body.get("attachmentIds", [])
+        for attachment_id in attachment_ids:
+            if not await async_db.get_attachment_info(attachment_id, user["id"]):
+                return JSONResponse({"error": "Attachment not found"}, status_code=404)
+
+        # The sender process (sender.py) does the sending, so this request
+        # returns straight away and no web worker timeout can interrupt it.
+        # Progress lives in shared state so a poll served by any worker sees it.
+        job_id = uuid.uuid4().hex
+        await async_db.run(shared_state.start_job, job_id, user["id"])
+        total = await async_db.create_send_job(
+            job_id,
+            user["id"],
+            csv_id,
+            csv_headers.index("email"),
             template["subject"],
-            template["body"]
+            template["body"],
+            template.get("isHtml", False),
+            sender_account_ids,
+            attachment_ids,
+            int(body.get("priority", 0)),
+            row_indexes,
+            segment_id,
         )
+        await async_db.run(shared_state.set_job_total, job_id, total)
 
-        # Log emails sent
-        for r in rows[:sent]:
-            log_email_sent(user["id"], r.get("email", ""), template["subject"])
-
-        return {"success": True, "emailsSent": sent}
+        return {"success": True, "jobId": job_id, "total": total}
 
     except Exception as e:
         print(f"❌ Send emails error: {str(e)}")
@@ -291,6 +744,189 @@ async def send_emails(request: Request):
         return JSONResponse({"error": str(e)}, status_code=500)
 
 
+@app.get("/send-jobs/{job_id}")
+def send_job_progress(job_id: str, request: Request):
+    """Progress of a send job, whichever worker is running it"""
+    session_id = request.cookies.get("session_id")
+    user = get_session(session_id) if session_id else None
+    if not user:
+        return JSONResponse({"error": "Unauthorized"}, status_code=401)
+
+    # Shared state is a cache; the durable record is in the main database
+    job = get_send_job(job_id, user["id"])
+    if not job:
+        return JSONResponse({"error": "Not found"}, status_code=404)
+
+    progress = shared_state.get_job(job_id, user["id"]) or {
+        "jobId": job[0],
+        "status": job[8],
+        "total": job[9],
+        "sent": job[10],
+        "failed": job[11],
+        "error": job[12],
+    }
+    # Found by the mailbox sync after sending
+    progress["replies"] = job[13]
+    progress["bounces"] = job[14]
+    return progress
+
+
+# ================== SEND HISTORY ==================
+
+HISTORY_FIELDS = (
+    "id", "sentAt", "recipient", "subject", "campaign", "senderAccountId", "sender",
+    "messageId", "threadId", "repliedAt", "bouncedAt",
+)
+
+
+def history_timestamp(value):
+    """A date or ISO datetime as stored in sent_at ('YYYY-MM-DD HH:MM:SS', UTC)"""
+    if not value:
+        return None
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo:
+        parsed = parsed.astimezone(timezone.utc)
+    return parsed.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def history_csv(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(HISTORY_FIELDS)
+    for count, row in enumerate(rows, start=1):
+        writer.writerow(row)
+        if count % EXPORT_CHUNK_ROWS == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def history_ndjson(rows):
+    lines = []
+    for row in rows:
+        lines.append(json.dumps(dict(zip(HISTORY_FIELDS, row))) + "\n")
+        if len(lines) == EXPORT_CHUNK_ROWS:
+            yield "".join(lines)
+            lines = []
+    yield "".join(lines)
+
+
+@app.get("/send-history/export")
+def export_send_history(request: Request, format: str = "csv", since: str = None, until: str = None,
+                        campaign: str = None, sender: int = None):
+    """
+    Stream the user's sent emails oldest first as CSV or NDJSON, optionally
+    from since (inclusive) to until (exclusive), for one campaign (job id)
+    and/or one sender account. Rows are written as they're read.
+    """
+    session_id = request.cookies.get("session_id")
+    user = get_session(session_id) if session_id else None
+    if not user:
+        return JSONResponse({"error": "Unauthorized"}, status_code=401)
+
+    if format not in ("csv", "ndjson"):
+        return JSONResponse({"error": "format must be csv or ndjson"}, status_code=400)
+    try:
+        since, until = history_timestamp(since), history_timestamp(until)
+    except ValueError:
+        return JSONResponse({"error": "since and until must be ISO dates"}, status_code=400)
+
+    rows = iter_sent_history(user["id"], since, until, campaign, sender)
+    if format == "csv":
+        return StreamingResponse(
+            history_csv(rows),
+            media_type="text/csv",
+            headers={"Content-Disposition": "attachment; filename=send-history.csv"},
+        )
+    return StreamingResponse(
+        history_ndjson(rows),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": "attachment; filename=send-history.ndjson"},
+    )
+
+
+# ================== DEAD LETTERS ==================
+
+@app.get("/dead-letters")
+def list_dead_letters(request: Request, jobId: str = None, kind: str = None, cursor: int = 0, limit: int = 50):
+    """Recipients that failed for good; pass nextCursor back as cursor for the next page"""
+    session_id = request.cookies.get("session_id")
+    user = get_session(session_id) if session_id else None
+    if not user:
+        return JSONResponse({"error": "Unauthorized"}, status_code=401)
+
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    rows = get_dead_letters(user["id"], jobId, kind, cursor, limit)
+    return {
+        "deadLetters": [
+            {
+                "id": r[0],
+                "jobId": r[1],
+                "rowIndex": r[2],
+                "email": r[3],
+                "kind": r[4],
+                "error": r[5],
+                "attempts": r[6],
+                "createdAt": r[7],
+            }
+            for r in rows
+        ],
+        "nextCursor": rows[-1][0] if len(rows) == limit else None,
+    }
+
+
+@app.post("/dead-letters/redrive")
+async def redrive_dead_letters_api(request: Request):
+    """Queue dead-lettered recipients again, selected by ids and/or jobId and kind"""
+    session_id = request.cookies.get("session_id")
+    user = await async_db.get_session(session_id) if session_id else None
+    if not user:
+        return JSONResponse({"error": "Unauthorized"}, status_code=401)
+
+    body = await request.json()
+    ids = body.get("ids")
+    if ids is None and not body.get("jobId") and not body.get("kind"):
+        return JSONResponse({"error": "Select dead letters by ids, jobId or kind"}, status_code=400)
+
+    counts = await async_db.redrive_dead_letters(user["id"], ids, body.get("jobId"), body.get("kind"))
+    for job_id, count in counts.items():
+        await async_db.run(shared_state.reopen_job, job_id, count)
+    return {"redriven": sum(counts.values()), "jobs": counts}
+
+
+# ================== SUPPRESSIONS ==================
+
+@app.get("/suppressions")
+def list_suppressions(request: Request, cursor: str = "", limit: int = 50):
+    """Addresses left out of new campaigns (replied or bounced)"""
+    session_id = request.cookies.get("session_id")
+    user = get_session(session_id) if session_id else None
+    if not user:
+        return JSONResponse({"error": "Unauthorized"}, status_code=401)
+
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    rows = get_suppressions(user["id"], cursor, limit)
+    return {
+        "suppressions": [
+            {"email": r[0], "reason": r[1], "jobId": r[2], "createdAt": r[3]}
+            for r in rows
+        ],
+        "nextCursor": rows[-1][0] if len(rows) == limit else None,
+    }
+
+
+@app.delete("/suppressions/{email}")
+def delete_suppression_api(email: str, request: Request):
+    session_id = request.cookies.get("session_id")
+    user = get_session(session_id) if session_id else None
+    if not user:
+        return JSONResponse({"error": "Unauthorized"}, status_code=401)
+
+    delete_suppression(user["id"], email)
+    return {"success": True}
+
+
 # ================== GMAIL ACCOUNTS ==================
 
 @app.get("/gmail/accounts")
@@ -302,12 +938,22 @@ def get_accounts(request: Request):
         return JSONResponse({"error": "Unauthorized"}, status_code=401)
 
     accounts = get_gmail_accounts(user["id"])
+    usage = get_account_usage([acc[0] for acc in accounts])
+    health = get_account_health([acc[0] for acc in accounts])
     return {
         "accounts": [
             {
                 "id": acc[0],
                 "email": acc[2],
                 "name": acc[3],
+                "sentToday": usage[acc[0]][0],
+                "dailyLimit": usage[acc[0]][1] or ACCOUNT_DAILY_LIMIT,
+                "health": {
+                    "state": health[acc[0]][0],
+                    "score": health[acc[0]][1],
+                    "consecutiveFailures": health[acc[0]][3],
+                    "lastError": health[acc[0]][4],
+                },
             }
             for acc in accounts
         ]
@@ -318,12 +964,12 @@ def get_accounts(request: Request):
 async def connect_gmail_account(request: Request):
     """Initiate OAuth flow for adding a new Gmail account"""
     session_id = request.cookies.get("session_id")
-    user = get_session(session_id) if session_id else None
+    user = await async_db.get_session(session_id) if session_id else None
     if not user:
         return JSONResponse({"error": "Unauthorized"}, status_code=401)
 
     # Check if user has reached the 3 account limit
-    account_count = count_gmail_accounts(user["id"])
+    account_count = await async_db.count_gmail_accounts(user["id"])
     if account_count >= 3:
         return JSONResponse({"error": "Maximum 3 Gmail accounts allowed"}, status_code=400)
 
@@ -338,7 +984,7 @@ async def connect_gmail_account(request: Request):
 async def gmail_connect_callback(request: Request):
     """Handle OAuth callback for additional Gmail account"""
     session_id = request.cookies.get("session_id")
-    user = get_session(session_id) if session_id else None
+    user = await async_db.get_session(session_id) if session_id else None
     if not user:
         return JSONResponse({"error": "Unauthorized"}, status_code=401)
 
@@ -348,7 +994,7 @@ async def gmail_connect_callback(request: Request):
         userinfo = token["userinfo"]
 
         # Add Gmail account to database
-        add_gmail_account(
+        await async_db.add_gmail_account(
             user["id"],
             userinfo["sub"],
             userinfo["email"],
@@ -393,7 +1039,7 @@ def delete_account(account_id: int, request: Request):
 async def update_account(account_id: int, request: Request):
     """Update Gmail account details (like sender name)"""
     session_id = request.cookies.get("session_id")
-    user = get_session(session_id) if session_id else None
+    user = await async_db.get_session(session_id) if session_id else None
     if not user:
         return JSONResponse({"error": "Unauthorized"}, status_code=401)
 
@@ -404,7 +1050,7 @@ async def update_account(account_id: int, request: Request):
         if not name:
             return JSONResponse({"error": "Name cannot be empty"}, status_code=400)
         
-        update_gmail_account_name(account_id, user["id"], name)
+        await async_db.update_gmail_account_name(account_id, user["id"], name)
         return {"success": True, "message": "Account updated successfully"}
     except Exception as e:
         print(f"❌ Error updating Gmail account: {str(e)}")
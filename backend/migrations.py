@@ -0,0 +1,455 @@
+"""
+Versioned schema migrations.
+The applied version is kept in SQLite's PRAGMA user_version. Migrations run
+once per deploy from the gunicorn master (see gunicorn.conf.py); workers only
+check the version on startup.
+Run manually with: python migrations.py
+"""
+import os
+import sqlite3
+
+import json
+
+from csv_store import compress_csv, content_hash, csv_text, row_hash
+from recipients import read_csv
+
+DB_PATH = os.getenv("DATABASE_PATH", "database.db")
+# Seconds a connection waits for another process's write lock before failing
+DB_BUSY_TIMEOUT = float(os.getenv("DATABASE_BUSY_TIMEOUT", "30"))
+
+
+def _add_column(conn, table, column):
+    try:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column}")
+    except sqlite3.OperationalError:
+        pass  # Column already exists
+
+
+def _base_schema(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        google_id TEXT UNIQUE,
+        email TEXT,
+        name TEXT,
+        gmail_token TEXT,
+        gmail_refresh_token TEXT
+    )
+    """)
+    # Databases created before Gmail tokens were stored on users
+    _add_column(conn, "users", "gmail_token TEXT")
+    _add_column(conn, "users", "gmail_refresh_token TEXT")
+
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS sessions (
+        session_id TEXT PRIMARY KEY,
+        user_id INTEGER,
+        data TEXT,
+        expires_at TIMESTAMP,
+        FOREIGN KEY(user_id) REFERENCES users(id)
+    )
+    """)
+
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS gmail_accounts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        gmail_id TEXT UNIQUE,
+        email TEXT,
+        name TEXT,
+        access_token TEXT,
+        refresh_token TEXT,
+        added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY(user_id) REFERENCES users(id)
+    )
+    """)
+
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS csvs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        filename TEXT,
+        content TEXT,
+        row_count INTEGER,
+        uploaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS emails_sent (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        recipient_email TEXT,
+        subject TEXT,
+        sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+
+
+def _attachments(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS attachment_blobs (
+        sha256 TEXT PRIMARY KEY,
+        content BLOB,
+        size INTEGER,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS attachments (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        sha256 TEXT,
+        filename TEXT,
+        mime_type TEXT,
+        uploaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY(user_id) REFERENCES users(id),
+        FOREIGN KEY(sha256) REFERENCES attachment_blobs(sha256)
+    )
+    """)
+
+
+def _templates(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS templates (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        name TEXT,
+        version INTEGER,
+        subject TEXT,
+        body TEXT,
+        is_html INTEGER DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE(user_id, name, version),
+        FOREIGN KEY(user_id) REFERENCES users(id)
+    )
+    """)
+
+
+def _csv_rows(conn):
+    _add_column(conn, "csvs", "headers TEXT")
+
+    # One row per CSV data row, so any page or row costs a primary key lookup
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS csv_rows (
+        csv_id INTEGER,
+        row_index INTEGER,
+        data TEXT,
+        PRIMARY KEY (csv_id, row_index)
+    ) WITHOUT ROWID
+    """)
+
+    # Index rows of CSVs uploaded before csv_rows existed
+    for (csv_id,) in conn.execute("SELECT id FROM csvs WHERE headers IS NULL").fetchall():
+        content = conn.execute("SELECT content FROM csvs WHERE id=?", (csv_id,)).fetchone()[0]
+        headers, rows = read_csv(csv_text(content, None))
+        rows = [(csv_id, row_index, json.dumps(values)) for row_index, values in rows]
+        conn.executemany("INSERT OR REPLACE INTO csv_rows (csv_id, row_index, data) VALUES (?, ?, ?)", rows)
+        conn.execute(
+            "UPDATE csvs SET headers=?, row_count=? WHERE id=?",
+            (json.dumps(headers), len(rows), csv_id),
+        )
+
+
+def _compress_csvs(conn):
+    """Move CSV payloads to gzip-compressed content_gz; returns True if VACUUM is needed"""
+    _add_column(conn, "csvs", "content_gz BLOB")
+
+    legacy = conn.execute(
+        "SELECT id FROM csvs WHERE content IS NOT NULL AND content_gz IS NULL"
+    ).fetchall()
+    for (csv_id,) in legacy:
+        content = conn.execute("SELECT content FROM csvs WHERE id=?", (csv_id,)).fetchone()[0]
+        conn.execute(
+            "UPDATE csvs SET content_gz=?, content=NULL WHERE id=?",
+            (compress_csv(content), csv_id),
+        )
+    return bool(legacy)
+
+
+def _send_jobs(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS send_jobs (
+        id TEXT PRIMARY KEY,
+        user_id INTEGER,
+        csv_id INTEGER,
+        subject TEXT,
+        body TEXT,
+        is_html INTEGER DEFAULT 0,
+        sender_account_ids TEXT,
+        attachment_ids TEXT,
+        status TEXT DEFAULT 'queued',
+        total INTEGER DEFAULT 0,
+        sent INTEGER DEFAULT 0,
+        failed INTEGER DEFAULT 0,
+        error TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY(user_id) REFERENCES users(id)
+    )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_send_jobs_status ON send_jobs (status, created_at)")
+
+    # One row per recipient; status moves pending -> claimed -> sent/failed
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS send_job_items (
+        job_id TEXT,
+        row_index INTEGER,
+        email TEXT,
+        status TEXT DEFAULT 'pending',
+        error TEXT,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (job_id, row_index)
+    ) WITHOUT ROWID
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_send_job_items_status ON send_job_items (job_id, status)")
+
+
+def _csv_hashes(conn):
+    _add_column(conn, "csvs", "content_hash TEXT")
+    _add_column(conn, "csv_rows", "row_hash TEXT")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_csvs_content_hash ON csvs (user_id, content_hash)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_csv_rows_hash ON csv_rows (csv_id, row_hash)")
+
+    for csv_id, content, content_gz in conn.execute(
+        "SELECT id, content, content_gz FROM csvs"
+    ).fetchall():
+        text = csv_text(content, content_gz)
+        conn.execute(
+            "UPDATE csvs SET content_hash=? WHERE id=?",
+            (content_hash(text.encode("utf-8")), csv_id),
+        )
+        hashes = [
+            (row_hash(json.loads(data)), csv_id, row_index)
+            for row_index, data in conn.execute(
+                "SELECT row_index, data FROM csv_rows WHERE csv_id=?", (csv_id,)
+            )
+        ]
+        conn.executemany("UPDATE csv_rows SET row_hash=? WHERE csv_id=? AND row_index=?", hashes)
+
+
+def _account_usage(conn):
+    # Optional per-account override of ACCOUNT_DAILY_LIMIT (e.g. 2000 for Workspace)
+    _add_column(conn, "gmail_accounts", "daily_limit INTEGER")
+
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS account_usage (
+        account_id INTEGER,
+        day TEXT,
+        sent INTEGER DEFAULT 0,
+        failed INTEGER DEFAULT 0,
+        PRIMARY KEY (account_id, day)
+    ) WITHOUT ROWID
+    """)
+
+
+def _account_health(conn):
+    # Circuit breaker state and recent success rate, kept between sender runs
+    _add_column(conn, "gmail_accounts", "health_score REAL DEFAULT 1.0")
+    _add_column(conn, "gmail_accounts", "circuit_state TEXT DEFAULT 'closed'")
+    _add_column(conn, "gmail_accounts", "circuit_open_until REAL")
+    _add_column(conn, "gmail_accounts", "consecutive_failures INTEGER DEFAULT 0")
+    _add_column(conn, "gmail_accounts", "last_error TEXT")
+    _add_column(conn, "gmail_accounts", "health_updated_at TIMESTAMP")
+
+
+def _send_retries(conn):
+    # Transient failures go back to pending with a time before which they
+    # aren't claimed again, so waiting for a retry holds no thread
+    _add_column(conn, "send_job_items", "attempts INTEGER DEFAULT 0")
+    _add_column(conn, "send_job_items", "next_attempt_at REAL")
+
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS dead_letters (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        job_id TEXT,
+        row_index INTEGER,
+        email TEXT,
+        kind TEXT,
+        error TEXT,
+        attempts INTEGER,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY(user_id) REFERENCES users(id)
+    )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_dead_letters_user ON dead_letters (user_id, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_dead_letters_job ON dead_letters (job_id, row_index)")
+
+
+def _recipient_domains(conn):
+    # domain_seq numbers each job's recipients within their domain, so claiming
+    # in (domain_seq, row_index) order interleaves domains
+    _add_column(conn, "send_job_items", "domain TEXT")
+    _add_column(conn, "send_job_items", "domain_seq INTEGER")
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_send_job_items_interleave
+        ON send_job_items (job_id, status, domain_seq, row_index)
+    """)
+
+    seqs = {}
+    updates = []
+    for job_id, row_index, email in conn.execute(
+        "SELECT job_id, row_index, email FROM send_job_items ORDER BY job_id, row_index"
+    ).fetchall():
+        domain = email.rpartition("@")[2].strip().lower()
+        seq = seqs[job_id, domain] = seqs.get((job_id, domain), 0) + 1
+        updates.append((domain, seq, job_id, row_index))
+    conn.executemany(
+        "UPDATE send_job_items SET domain=?, domain_seq=? WHERE job_id=? AND row_index=?", updates
+    )
+
+
+def _fair_share(conn):
+    # Tenant share of the sender (weight) and cap on its concurrent slices;
+    # NULL cap means SENDER_TENANT_MAX_SLICES
+    _add_column(conn, "users", "send_weight INTEGER DEFAULT 1")
+    _add_column(conn, "users", "max_concurrent_jobs INTEGER")
+    # Order of a tenant's own jobs: higher priority first, then oldest
+    _add_column(conn, "send_jobs", "priority INTEGER DEFAULT 0")
+
+
+def _mailbox_sync(conn):
+    # Which job/account sent each email and Gmail's ids for it, so replies and
+    # bounces found in the mailbox can be matched back by thread
+    _add_column(conn, "emails_sent", "job_id TEXT")
+    _add_column(conn, "emails_sent", "account_id INTEGER")
+    _add_column(conn, "emails_sent", "message_id TEXT")
+    _add_column(conn, "emails_sent", "thread_id TEXT")
+    _add_column(conn, "emails_sent", "replied_at TIMESTAMP")
+    _add_column(conn, "emails_sent", "bounced_at TIMESTAMP")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_emails_sent_thread ON emails_sent (account_id, thread_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_emails_sent_recipient ON emails_sent (account_id, recipient_email)")
+
+    # Last Gmail history id seen per account; sync fetches only changes after it
+    _add_column(conn, "gmail_accounts", "history_id TEXT")
+    _add_column(conn, "gmail_accounts", "last_synced_at TIMESTAMP")
+
+    _add_column(conn, "send_jobs", "replies INTEGER DEFAULT 0")
+    _add_column(conn, "send_jobs", "bounces INTEGER DEFAULT 0")
+
+    # Addresses never mailed again by a user's campaigns
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS suppressions (
+        user_id INTEGER,
+        email TEXT,
+        reason TEXT,
+        job_id TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (user_id, email)
+    ) WITHOUT ROWID
+    """)
+
+
+def _send_history(conn):
+    # Keyset order of the send history export; also serves its date filters
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_emails_sent_history ON emails_sent (user_id, sent_at, id)")
+
+
+def _segments(conn):
+    # Saved filters over a CSV's rows (see segments.py); evaluated when a job
+    # is queued, so rows appended later are included
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS segments (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        csv_id INTEGER,
+        name TEXT,
+        filter TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_segments_user ON segments (user_id, csv_id)")
+    _add_column(conn, "send_jobs", "segment_id INTEGER")
+
+
+def _csv_blobs(conn):
+    # Appends stored content_gz as TEXT (|| returns TEXT), which can't be read
+    # back as a string; the bytes are unchanged, so retyping them is enough
+    conn.execute("UPDATE csvs SET content_gz = CAST(content_gz AS BLOB) WHERE typeof(content_gz)='text'")
+
+
+# Append new steps at the end; never reorder or edit applied ones
+MIGRATIONS = [
+    _base_schema,
+    _attachments,
+    _templates,
+    _csv_rows,
+    _compress_csvs,
+    _send_jobs,
+    _csv_hashes,
+    _account_usage,
+    _account_health,
+    _send_retries,
+    _recipient_domains,
+    _fair_share,
+    _mailbox_sync,
+    _send_history,
+    _segments,
+    _csv_blobs,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def connect(path=DB_PATH):
+    # Autocommit mode; migrate() manages its own transactions
+    conn = sqlite3.connect(path, isolation_level=None, timeout=DB_BUSY_TIMEOUT)
+    # Web workers, the sender and its sync thread all write to this file. WAL
+    # lets readers and one writer proceed together; the mode is stored in the
+    # database, so this is a no-op after the first run
+    conn.execute("PRAGMA journal_mode=WAL")
+    return conn
+
+
+def schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(path=DB_PATH):
+    """Apply pending migrations; safe to call from several processes at once"""
+    conn = connect(path)
+    try:
+        if schema_version(conn) >= SCHEMA_VERSION:
+            return 0
+
+        applied = 0
+        vacuum = False
+        for version, step in enumerate(MIGRATIONS, start=1):
+            # The write lock makes concurrent callers apply each step once
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if schema_version(conn) >= version:
+                    conn.execute("ROLLBACK")
+                    continue
+                vacuum = step(conn) or vacuum
+                conn.execute(f"PRAGMA user_version = {version}")
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            applied += 1
+            print(f"✅ Applied migration {version}: {step.__name__.lstrip('_')}")
+
+        if vacuum:
+            conn.execute("VACUUM")
+        return applied
+    finally:
+        conn.close()
+
+
+def ensure_schema(path=DB_PATH):
+    """Cheap startup check: one PRAGMA read when the schema is current"""
+    conn = connect(path)
+    try:
+        current = schema_version(conn)
+    finally:
+        conn.close()
+    if current < SCHEMA_VERSION:
+        migrate(path)
+
+
+if __name__ == "__main__":
+    count = migrate()
+    print(f"Schema at version {SCHEMA_VERSION} ({count} migration(s) applied)")
@@ -0,0 +1,50 @@
+"""Compact recipient records and the streaming CSV reader used to index uploads"""
+import csv
+
+
+class Recipient:
+    """One recipient row. All rows of a list share a single headers tuple."""
+    __slots__ = ("index", "email", "headers", "values")
+
+    def __init__(self, index, email, headers, values):
+        self.index = index
+        self.email = email
+        self.headers = headers
+        self.values = values
+
+    def fields(self):
+        """Return the row as a dict for template formatting"""
+        return dict(zip(self.headers, self.values))
+
+
+def iter_lines(content):
+    """
+    Yield lines of a CSV string, line endings included, without copying the
+    whole text (io.StringIO would hold a 4-byte-per-character copy)
+    """
+    start = 0
+    length = len(content)
+    while start < length:
+        end = content.find("\n", start)
+        end = length if end == -1 else end + 1
+        yield content[start:end]
+        start = end
+
+
+def read_csv(content):
+    """
+    Parse CSV text lazily; quoted fields may span lines.
+    Returns (headers, rows) where rows yields (row_index, values) for each
+    non-blank data row.
+    """
+    # Lines keep their endings so csv joins quoted multi-line fields itself;
+    # blank rows are dropped only after parsing
+    reader = (
+        row for row in csv.reader(iter_lines(content))
+        if row and not (len(row) == 1 and not row[0].strip())
+    )
+    try:
+        headers = tuple(h.strip() for h in next(reader))
+    except StopIteration:
+        return (), iter(())
+    return headers, enumerate(reader)
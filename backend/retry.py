@@ -0,0 +1,53 @@
+"""Failure classification and backoff for recipient sends"""
+import os
+import random
+
+from dispatcher import http_status, is_account_error
+
+# A recipient is dead-lettered after this many failed attempts
+SEND_MAX_ATTEMPTS = int(os.getenv("SEND_MAX_ATTEMPTS", "5"))
+SEND_RETRY_BASE_SECONDS = float(os.getenv("SEND_RETRY_BASE_SECONDS", "30"))
+SEND_RETRY_MAX_SECONDS = float(os.getenv("SEND_RETRY_MAX_SECONDS", "3600"))
+
+ACCOUNT = "account"
+TRANSIENT = "transient"
+INVALID_RECIPIENT = "invalid_recipient"
+PERMANENT = "permanent"
+
+# Connection-level failures raised by httplib2/requests/ssl have no HTTP status
+_TRANSIENT_ERROR_NAMES = ("Timeout", "ServerNotFound", "Connection", "SSLError", "IncompleteRead")
+
+
+def classify_error(error):
+    """
+    Why a send failed:
+    ACCOUNT - the sending account's fault (auth, quota, throttling); re-route
+    TRANSIENT - 5xx or network trouble; retry later
+    INVALID_RECIPIENT - Gmail rejected the address; never retry
+    PERMANENT - any other 4xx or a message we couldn't build; never retry
+    """
+    if is_account_error(error):
+        return ACCOUNT
+    status = http_status(error)
+    if status is None:
+        if isinstance(error, (OSError, TimeoutError)) or any(
+            name in type(error).__name__ for name in _TRANSIENT_ERROR_NAMES
+        ):
+            return TRANSIENT
+        return PERMANENT
+    if status >= 500 or status == 408:
+        return TRANSIENT
+    if status == 400 and ("invalid to header" in str(error).lower() or "recipient address" in str(error).lower()):
+        return INVALID_RECIPIENT
+    return PERMANENT
+
+
+def retry_delay(attempts):
+    """Seconds before attempt number attempts + 1: exponential, capped, with jitter"""
+    delay = min(SEND_RETRY_MAX_SECONDS, SEND_RETRY_BASE_SECONDS * 2 ** (attempts - 1))
+    # Jitter spreads retries of a burst of failures out over time
+    return delay * random.uniform(0.5, 1.0)
+
+
+def should_retry(kind, attempts):
+    return kind == TRANSIENT and attempts < SEND_MAX_ATTEMPTS
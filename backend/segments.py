@@ -0,0 +1,369 @@
+"""
+Recipient segments: a small filter language evaluated over a columnar
+(pandas) view of a stored CSV, for example
+
+    company_size > 50 and country = IN
+    (title contains founder or title contains ceo) and not country in (US, CA)
+    `company name` != ""
+
+Comparing with a number compares numerically; cells that aren't numbers never
+match. Anything else compares as trimmed, case-insensitive text. Quote a
+value ("02134") to compare it as text, and put column names with spaces or
+keywords in backticks.
+
+Loaded frames are cached per CSV and evicted least recently used once the
+cache grows past SEGMENT_CACHE_MB.
+"""
+import operator
+import os
+import re
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from db import iter_csv_column_batches
+
+# Per process; frames are reloaded from csv_rows after eviction
+SEGMENT_CACHE_MB = float(os.getenv("SEGMENT_CACHE_MB", "256"))
+MAX_FILTER_LENGTH = 2000
+
+COMPARISONS = {
+    "=": operator.eq,
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+
+_TOKEN = re.compile(r"""\s*(?:
+    (?P<op><=|>=|!=|==|=|<|>|\(|\)|,)
+  | `(?P<column>[^`]*)`
+  | "(?P<dquote>[^"]*)"
+  | '(?P<squote>[^']*)'
+  | (?P<word>[^\s=!<>(),"'`]+)
+)""", re.X)
+
+
+class FilterError(ValueError):
+    """A filter expression that doesn't parse or names an unknown column"""
+
+
+# ================== PARSING ==================
+
+def tokenize(expression):
+    """[(kind, text)] with kind one of op, column, string, word (keywords included)"""
+    tokens = []
+    position = 0
+    expression = expression.rstrip()
+    while position < len(expression):
+        match = _TOKEN.match(expression, position)
+        if not match:
+            raise FilterError(f"Unexpected character at position {position}: {expression[position]!r}")
+        kind = match.lastgroup
+        text = match.group(kind)
+        if kind in ("dquote", "squote"):
+            kind = "string"
+        tokens.append((kind, text))
+        position = match.end()
+    return tokens
+
+
+class _Parser:
+    """
+    Recursive descent over:
+    expr := and_expr ("or" and_expr)*
+    and_expr := factor ("and" factor)*
+    factor := "not" factor | "(" expr ")" | column condition
+    condition := op value | "contains" value | "startswith" value | ["not"] "in" "(" value ("," value)* ")"
+    """
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else (None, None)
+
+    def matches(self, kind, text):
+        # Keywords are bare words, recognized only where the grammar expects
+        # one, so a value like IN or a column named "country" still works
+        token_kind, token_text = self.peek()
+        if kind == "keyword":
+            return token_kind == "word" and token_text.lower() == text
+        return token_kind == kind and token_text == text
+
+    def take(self, kind, text):
+        if not self.matches(kind, text):
+            found = self.peek()[1] or "end of filter"
+            raise FilterError(f"Expected {text!r}, found {found!r}")
+        self.position += 1
+
+    def accept(self, kind, text):
+        if self.matches(kind, text):
+            self.position += 1
+            return True
+        return False
+
+    def parse(self):
+        tree = self.expr()
+        if self.position < len(self.tokens):
+            raise FilterError(f"Unexpected {self.tokens[self.position][1]!r}")
+        return tree
+
+    def expr(self):
+        node = self.and_expr()
+        while self.accept("keyword", "or"):
+            node = ("or", node, self.and_expr())
+        return node
+
+    def and_expr(self):
+        node = self.factor()
+        while self.accept("keyword", "and"):
+            node = ("and", node, self.factor())
+        return node
+
+    def factor(self):
+        if self.accept("keyword", "not"):
+            return ("not", self.factor())
+        if self.accept("op", "("):
+            node = self.expr()
+            self.take("op", ")")
+            return node
+
+        kind, column = self.peek()
+        if kind not in ("word", "column"):
+            raise FilterError(f"Expected a column name, found {column or 'end of filter'!r}")
+        self.position += 1
+
+        if self.accept("keyword", "contains"):
+            return ("contains", column, self.value()[0])
+        if self.accept("keyword", "startswith"):
+            return ("startswith", column, self.value()[0])
+        negate = self.accept("keyword", "not")
+        if negate or self.accept("keyword", "in"):
+            if negate:
+                self.take("keyword", "in")
+            self.take("op", "(")
+            values = [self.value()[0]]
+            while self.accept("op", ","):
+                values.append(self.value()[0])
+            self.take("op", ")")
+            node = ("in", column, tuple(values))
+            return ("not", node) if negate else node
+
+        kind, op = self.peek()
+        if op not in COMPARISONS:
+            raise FilterError(f"Expected a comparison after {column!r}")
+        self.position += 1
+        return ("compare", op, column, self.value())
+
+    def value(self):
+        """(text, number or None); quoted values are never numbers"""
+        kind, text = self.peek()
+        if kind not in ("word", "string"):
+            raise FilterError(f"Expected a value, found {text or 'end of filter'!r}")
+        self.position += 1
+        if kind == "word":
+            try:
+                return text, float(text)
+            except ValueError:
+                pass
+        return text, None
+
+
+def parse_filter(expression):
+    """Parse a filter expression into a tree of tuples"""
+    if not expression or not expression.strip():
+        raise FilterError("Filter is empty")
+    if len(expression) > MAX_FILTER_LENGTH:
+        raise FilterError(f"Filter is longer than {MAX_FILTER_LENGTH} characters")
+    return _Parser(tokenize(expression)).parse()
+
+
+def filter_columns(tree):
+    """Every column name a parsed filter refers to"""
+    if tree[0] in ("and", "or"):
+        return filter_columns(tree[1]) | filter_columns(tree[2])
+    if tree[0] == "not":
+        return filter_columns(tree[1])
+    return {tree[2] if tree[0] == "compare" else tree[1]}
+
+
+def check_filter(expression, headers):
+    """Parse a filter and make sure its columns exist; raises FilterError"""
+    tree = parse_filter(expression)
+    unknown = sorted(filter_columns(tree) - set(headers))
+    if unknown:
+        raise FilterError(f"Unknown column: {unknown[0]}")
+    return tree
+
+
+# ================== COLUMNAR FRAMES ==================
+
+def _estimated_bytes(data, sample=1000):
+    """Deep memory use of a frame or series, scaled up from its first rows"""
+    if len(data) <= sample:
+        return int(pd.Series(data.memory_usage(index=False, deep=True)).sum())
+    head = data.iloc[:sample].memory_usage(index=False, deep=True)
+    return int(pd.Series(head).sum() * len(data) / sample)
+
+
+def _number(value):
+    """A cell as a float, read the way filter values are (surrounding whitespace ignored), or NaN"""
+    try:
+        return float(value)
+    except ValueError:
+        return np.nan
+
+
+class ColumnFrame:
+    """
+    One CSV's rows as columns, read from csv_rows the first time a filter uses
+    them; columns no filter has used are never loaded. Normalized text and
+    numeric versions of a column are built the same way.
+    """
+
+    def __init__(self, csv_id, headers, row_count):
+        self.csv_id = csv_id
+        self.row_count = row_count
+        # Positional columns, since CSV headers may repeat (the first one wins)
+        self.positions = {}
+        for position, header in enumerate(headers):
+            self.positions.setdefault(header, position)
+        # Fixed by the first load, so later columns line up with it
+        self.row_indexes = None
+        self._columns = {}
+        self._text = {}
+        self._numbers = {}
+        self._lock = threading.Lock()
+        self.nbytes = 0
+
+    def load(self, columns):
+        """Read the columns that aren't loaded yet, in one pass over the rows"""
+        with self._lock:
+            positions = sorted({self.positions[column] for column in columns} - set(self._columns))
+            if not positions:
+                return
+            last_row_index = None if self.row_indexes is None else (
+                int(self.row_indexes[-1]) if len(self.row_indexes) else -1)
+            row_indexes = []
+            values = [[] for _ in positions]
+            for batch_indexes, batch_columns in iter_csv_column_batches(self.csv_id, positions, last_row_index):
+                row_indexes.extend(batch_indexes)
+                for column_values, batch_values in zip(values, batch_columns):
+                    column_values.extend(batch_values)
+
+            # Every load is kept in row order, so its columns line up with the first's
+            row_indexes = np.array(row_indexes, dtype=np.int64)
+            order = np.argsort(row_indexes, kind="stable")
+            if self.row_indexes is None:
+                self.row_indexes = row_indexes[order]
+                self.nbytes += self.row_indexes.nbytes
+            for position, column_values in zip(positions, values):
+                # Short rows have no cell; they compare as ""
+                series = pd.Series(np.array(column_values, dtype=object)[order], dtype=object).fillna("")
+                self._columns[position] = series
+                self.nbytes += _estimated_bytes(series)
+
+    def column(self, column):
+        return self._columns[self.positions[column]]
+
+    def text(self, column):
+        series = self._text.get(column)
+        if series is None:
+            series = pd.Series([value.strip().lower() for value in self.column(column).to_numpy()], dtype=object)
+            self._text[column] = series
+            self.nbytes += _estimated_bytes(series)
+        return series
+
+    def numbers(self, column):
+        array = self._numbers.get(column)
+        if array is None:
+            values = self.column(column).to_numpy()
+            array = np.fromiter(map(_number, values), float, count=len(values))
+            self._numbers[column] = array
+            self.nbytes += array.nbytes
+        return array
+
+    def mask(self, tree):
+        """Boolean array of the rows a parsed filter matches"""
+        kind = tree[0]
+        if kind == "and":
+            return self.mask(tree[1]) & self.mask(tree[2])
+        if kind == "or":
+            return self.mask(tree[1]) | self.mask(tree[2])
+        if kind == "not":
+            return ~self.mask(tree[1])
+        # Plain loops: pandas' .str methods are several times slower on object columns
+        if kind == "contains":
+            needle = tree[2].lower()
+            values = self.text(tree[1]).to_numpy()
+            return np.fromiter((needle in value for value in values), bool, count=len(values))
+        if kind == "startswith":
+            prefix = tree[2].lower()
+            values = self.text(tree[1]).to_numpy()
+            return np.fromiter((value.startswith(prefix) for value in values), bool, count=len(values))
+        if kind == "in":
+            return self.text(tree[1]).isin([v.lower() for v in tree[2]]).to_numpy(bool)
+
+        _, op, column, (text, number) = tree
+        if number is not None:
+            numbers = self.numbers(column)
+            # NaN never compares equal, but != would match every non-number
+            return COMPARISONS[op](numbers, number) & ~np.isnan(numbers)
+        return COMPARISONS[op](self.text(column).to_numpy(), text.lower()).astype(bool)
+
+
+class FrameCache:
+    """Least recently used ColumnFrames per csv_id, bounded by total bytes"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._frames = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, csv_id, headers, row_count):
+        """The CSV's frame, new (nothing loaded yet) unless cached at this row count"""
+        with self._lock:
+            frame = self._frames.get(csv_id)
+            if frame is not None and frame.row_count == row_count:
+                self._frames.move_to_end(csv_id)
+                return frame
+        # An appended list has a new row count
+        frame = ColumnFrame(csv_id, headers, row_count)
+        with self._lock:
+            self._frames[csv_id] = frame
+            self._frames.move_to_end(csv_id)
+        self.trim()
+        return frame
+
+    def trim(self):
+        """Evict the least recently used frames until under max_bytes; the newest always stays"""
+        with self._lock:
+            total = sum(frame.nbytes for frame in self._frames.values())
+            while total > self.max_bytes and len(self._frames) > 1:
+                _, frame = self._frames.popitem(last=False)
+                total -= frame.nbytes
+
+    def discard(self, csv_id):
+        with self._lock:
+            self._frames.pop(csv_id, None)
+
+
+frame_cache = FrameCache(int(SEGMENT_CACHE_MB * 1024 * 1024))
+
+
+def matching_rows(csv_id, headers, row_count, expression):
+    """Sorted row indexes of a CSV that match a filter; raises FilterError"""
+    tree = check_filter(expression, headers)
+    frame = frame_cache.get(csv_id, headers, row_count)
+    # Loaded outside the cache's lock
+    frame.load(filter_columns(tree))
+    rows = frame.row_indexes[frame.mask(tree)]
+    # Loaded and derived columns may have grown the frame
+    frame_cache.trim()
+    return rows
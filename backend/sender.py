@@ -0,0 +1,340 @@
+"""
+Background sender process.
+Runs send jobs queued by /send-emails outside the web workers, so gunicorn's
+request timeout and worker recycling never cut a send short. The gunicorn
+master starts and restarts it (see gunicorn.conf.py); it can also be run
+directly with: python sender.py
+
+Jobs run as time-boxed slices in SENDER_SLOTS threads, shared fairly between
+users (see fair_share.py).
+
+On SIGTERM it stops claiming recipients, lets in-flight sends finish and
+puts anything claimed but unsent back in the queue.
+"""
+import functools
+import os
+import signal
+import sqlite3
+import threading
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+import shared_state
+from db import (
+    get_csv_info,
+    get_gmail_account,
+    get_attachment_info,
+    get_attachment_blob,
+    get_send_job,
+    runnable_send_jobs,
+    get_account_usage,
+    record_account_send,
+    get_account_health,
+    save_account_health,
+    claim_send_items,
+    record_sent_item,
+    retry_send_item,
+    dead_letter_send_item,
+    release_send_items,
+    reset_claimed_send_items,
+    finish_send_job,
+)
+from dispatcher import AccountsUnavailable, QuotaExhausted
+from domains import DomainSlots
+from fair_share import FairShareScheduler
+from mailbox_sync import MAILBOX_SYNC_INTERVAL, sync_all_accounts
+from gmail_mailer import MessageBuilder, send_batch_via_gmail
+from migrations import ensure_schema
+from recipients import Recipient
+from retry import classify_error, retry_delay, should_retry
+from templating import LRUCache
+
+# Small claims keep the amount of work to hand back on shutdown low
+CLAIM_BATCH_SIZE = int(os.getenv("SENDER_CLAIM_BATCH_SIZE", "25"))
+POLL_INTERVAL = float(os.getenv("SENDER_POLL_INTERVAL", "2"))
+# Jobs whose accounts ran out of daily quota are retried after this long
+QUOTA_RETRY_SECONDS = int(os.getenv("SENDER_QUOTA_RETRY_SECONDS", "900"))
+# Job slices that may run at once
+SENDER_SLOTS = int(os.getenv("SENDER_SLOTS", "4"))
+# A slice that hit a database error (e.g. a lock held past the busy timeout)
+# is retried after this long
+DB_RETRY_SECONDS = float(os.getenv("SENDER_DB_RETRY_SECONDS", "10"))
+# Jobs' attachment sets kept encoded between slices (up to ~4 MB per attachment)
+ATTACHMENT_CACHE_SIZE = int(os.getenv("SENDER_ATTACHMENT_CACHE_SIZE", "8"))
+
+stopping = threading.Event()
+# Set whenever a slice finishes, so the scheduler can fill its slot
+slot_freed = threading.Event()
+# job_id -> monotonic time before which the job isn't picked up again.
+# Written by slot threads and read by the main loop, always under deferred_lock
+deferred = {}
+deferred_lock = threading.Lock()
+# job_id -> [(row_index, email, account_id, message_id, thread_id)] sent but not yet
+# recorded because the database write failed; recorded before the job's next
+# slice claims anything, so they aren't sent twice
+unrecorded = {}
+# Sends in flight per recipient domain across every slice, so slices running
+# side by side share each domain's max_concurrent
+domain_slots = DomainSlots()
+# (filename, mime_type, sha256) per attachment -> MessageBuilder with them encoded,
+# so a job's attachments are read and encoded once, not on every slice
+attachment_builders = LRUCache(ATTACHMENT_CACHE_SIZE)
+
+
+def defer(job_id, seconds):
+    """Keep a job from being picked up again for seconds"""
+    with deferred_lock:
+        deferred[job_id] = time.monotonic() + seconds
+
+
+def claimed_recipients(job_id, headers, attempts, budget, should_stop):
+    """
+    Claim up to budget due recipients a batch at a time until none are left
+    or should_stop(). Fills attempts with each claimed row's previous failed attempts.
+    """
+    while budget > 0 and not should_stop():
+        batch = claim_send_items(job_id, min(CLAIM_BATCH_SIZE, budget))
+        if not batch:
+            return
+        budget -= len(batch)
+        for row_index, email, values, previous_attempts in batch:
+            if should_stop():
+                return
+            attempts[row_index] = previous_attempts
+            yield Recipient(row_index, email, headers, tuple(values))
+
+
+def job_message_builder(user_id, attachment_ids):
+    """A MessageBuilder with a job's attachments encoded, or None if one is missing"""
+    infos = [get_attachment_info(attachment_id, user_id) for attachment_id in attachment_ids]
+    if not all(infos):
+        return None
+    key = tuple((filename, mime_type, sha256) for _, filename, mime_type, sha256 in infos)
+    builder = attachment_builders.get(key)
+    if builder is None:
+        attachments = [(filename, mime_type, get_attachment_blob(sha256)) for filename, mime_type, sha256 in key]
+        if any(content is None for _, _, content in attachments):
+            return None
+        builder = MessageBuilder(attachments)
+        attachment_builders.put(key, builder)
+    return builder
+
+
+def run_job(job, budget=float("inf"), seconds=float("inf")):
+    """
+    Send up to budget of a job's pending recipients for at most about seconds.
+    Returns how many recipients were attempted.
+    """
+    (job_id, user_id, csv_id, subject, body, is_html,
+     sender_account_ids, attachment_ids, *_) = job
+
+    csv_info = get_csv_info(csv_id, user_id)
+    if not csv_info:
+        finish_send_job(job_id, "failed", "CSV not found")
+        shared_state.finish_job(job_id, "failed", "CSV not found")
+        return 0
+    headers, _ = csv_info
+
+    sender_accounts = []
+    for account_id in sender_account_ids:
+        account = get_gmail_account(account_id, user_id)
+        if account:
+            account_id, gmail_id, email, name, access_token, refresh_token = account
+            sender_accounts.append((account_id, email, name, access_token, refresh_token))
+    if not sender_accounts:
+        finish_send_job(job_id, "failed", "No valid sender accounts")
+        shared_state.finish_job(job_id, "failed", "No valid sender accounts")
+        return 0
+
+    builder = job_message_builder(user_id, attachment_ids)
+    if builder is None:
+        # Never send the campaign without a file it promised
+        finish_send_job(job_id, "failed", "Attachment not found")
+        shared_state.finish_job(job_id, "failed", "Attachment not found")
+        return 0
+
+    progress = shared_state.JobProgress(job_id)
+    pending_records = unrecorded.pop(job_id, [])
+    while pending_records:
+        try:
+            record_sent_item(job_id, user_id, subject, *pending_records[0])
+        except Exception:
+            unrecorded[job_id] = pending_records
+            raise
+        pending_records.pop(0)
+        progress.record(True)
+
+    attempts = {}
+    deadline = time.monotonic() + seconds
+    used = 0
+
+    def should_stop():
+        return stopping.is_set() or used >= budget or time.monotonic() >= deadline
+
+    def on_sent(recipient, account_id, sent):
+        nonlocal used
+        used += 1
+        attempts.pop(recipient.index, None)
+        record = (recipient.index, recipient.email, account_id, sent.get("id"), sent.get("threadId"))
+        try:
+            record_sent_item(job_id, user_id, subject, *record)
+        except Exception:
+            # Gmail has sent it: keep it to record later rather than send again
+            unrecorded.setdefault(job_id, []).append(record)
+            raise
+        progress.record(True)
+
+    def on_failed(recipient, account_id, error):
+        nonlocal used
+        used += 1
+        if account_id is not None:
+            record_account_send(account_id, False)
+        kind = classify_error(error)
+        tries = attempts.pop(recipient.index, 0) + 1
+        if should_retry(kind, tries):
+            delay = retry_delay(tries)
+            print(f"🔁 Retrying {recipient.email} in {delay:.0f}s (attempt {tries}): {str(error)}")
+            retry_send_item(job_id, recipient.index, str(error), delay)
+            return
+        dead_letter_send_item(job_id, recipient.index, str(error), kind)
+        progress.record(False)
+
+    account_ids = [a[0] for a in sender_accounts]
+    health = {
+        account_id: row[:4] for account_id, row in get_account_health(account_ids).items()
+    }
+
+    print(f"📤 Sending job {job_id}")
+    try:
+        send_batch_via_gmail(
+            sender_accounts,
+            claimed_recipients(job_id, headers, attempts, budget, should_stop),
+            subject,
+            body,
+            on_sent=on_sent,
+            message_builder=builder,
+            is_html=is_html,
+            on_failed=on_failed,
+            usage=get_account_usage(account_ids),
+            health=health,
+            on_health=save_account_health,
+            should_stop=should_stop,
+            domain_slots=domain_slots,
+        )
+    except QuotaExhausted:
+        print(f"⏸️ Job {job_id} paused: sender accounts are out of daily quota")
+        defer(job_id, QUOTA_RETRY_SECONDS)
+        return used
+    except AccountsUnavailable as e:
+        print(f"⏸️ Job {job_id} paused: every sender account's circuit is open")
+        defer(job_id, max(e.retry_after, POLL_INTERVAL))
+        return used
+    finally:
+        # Checkpoint: anything claimed but not sent goes back to pending
+        release_send_items(job_id)
+        progress.flush()
+
+    if finish_send_job(job_id):
+        shared_state.finish_job(job_id)
+        print(f"✅ Job {job_id} finished")
+    return used
+
+
+def run_slice(job_id, budget, seconds, finished):
+    """Run one slice of a job on a slot thread; finished(used) is always called"""
+    used = 0
+    try:
+        job = get_send_job(job_id)
+        if job:
+            used = run_job(job, budget, seconds)
+    except sqlite3.OperationalError as e:
+        # Transient (locked/busy database): the job keeps its pending items
+        # and is picked up again later
+        print(f"⚠️ Send job {job_id} paused by a database error: {str(e)}")
+        try:
+            release_send_items(job_id)
+        except sqlite3.OperationalError:
+            pass  # Claims left behind are reset when the sender restarts
+        defer(job_id, DB_RETRY_SECONDS)
+    except Exception as e:
+        print(f"❌ Send job {job_id} error: {str(e)}")
+        finish_send_job(job_id, "failed", str(e))
+        shared_state.finish_job(job_id, "failed", str(e))
+    finally:
+        finished(used)
+
+
+def handle_stop(signum, frame):
+    print("⏳ Sender draining: finishing in-flight sends")
+    stopping.set()
+
+
+def main():
+    ensure_schema()
+    signal.signal(signal.SIGTERM, handle_stop)
+    signal.signal(signal.SIGINT, handle_stop)
+
+    # Anything still claimed belongs to a previous process that died mid-send
+    reset_claimed_send_items()
+    print(f"📮 Sender process {os.getpid()} started")
+
+    scheduler = FairShareScheduler()
+    # job_id -> (user_id, budget, weight, thread) for slices in progress
+    running = {}
+    # (job_id, used) reported by slot threads, applied on this thread
+    finished = []
+
+    def slice_done(job_id, used):
+        finished.append((job_id, used))
+        slot_freed.set()
+
+    sync_thread = None
+    next_sync = time.monotonic()
+
+    while not stopping.is_set():
+        while finished:
+            job_id, used = finished.pop()
+            user_id, budget, weight, thread = running.pop(job_id)
+            scheduler.finished(user_id, budget, used, weight)
+
+        now = time.monotonic()
+        with deferred_lock:
+            for job_id in [j for j, until in deferred.items() if until <= now]:
+                del deferred[job_id]
+            paused = list(deferred)
+
+        # Reply/bounce sync runs beside the sends, never more than one at a time
+        if MAILBOX_SYNC_INTERVAL and now >= next_sync and not (sync_thread and sync_thread.is_alive()):
+            sync_thread = threading.Thread(target=sync_all_accounts, daemon=True)
+            sync_thread.start()
+            next_sync = now + MAILBOX_SYNC_INTERVAL
+
+        if len(running) < SENDER_SLOTS:
+            jobs = runnable_send_jobs(exclude=paused + list(running))
+            picked = scheduler.pick(jobs)
+            if picked:
+                job_id, user_id, budget, seconds = picked
+                weight = next(job[2] for job in jobs if job[0] == job_id)
+                thread = threading.Thread(
+                    target=run_slice,
+                    args=(job_id, budget, seconds, functools.partial(slice_done, job_id)),
+                    daemon=True,
+                )
+                running[job_id] = (user_id, budget, weight, thread)
+                thread.start()
+                continue
+
+        slot_freed.wait(POLL_INTERVAL)
+        slot_freed.clear()
+
+    # Drain: slices see stopping, finish their in-flight sends and requeue the rest
+    for user_id, budget, weight, thread in running.values():
+        thread.join()
+    print("👋 Sender stopped")
+
+
+if __name__ == "__main__":
+    main()
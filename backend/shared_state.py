@@ -0,0 +1,231 @@
+"""
+State shared by all gunicorn workers on one host: send job progress,
+refreshed Gmail access tokens and rate-limiter buckets.
+Backed by a local SQLite file in WAL mode, so it needs no external service.
+"""
+import os
+import sqlite3
+import threading
+import time
+
+try:
+    from crypto_utils import encrypt_token, decrypt_token
+except ImportError:
+    def encrypt_token(token):
+        return token
+    def decrypt_token(token):
+        return token
+
+SHARED_STATE_PATH = os.getenv("SHARED_STATE_PATH", "shared_state.db")
+
+# Progress is written at most this often per job, not on every email
+PROGRESS_FLUSH_INTERVAL = 1.0
+
+_local = threading.local()
+_schema_lock = threading.Lock()
+_schema_ready = set()
+
+
+def _connect():
+    """Per-thread connection; also holds that thread's token cache"""
+    state = getattr(_local, "state", None)
+    if state is not None and state["path"] == SHARED_STATE_PATH:
+        return state
+
+    conn = sqlite3.connect(SHARED_STATE_PATH, isolation_level=None, timeout=10)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    with _schema_lock:
+        if SHARED_STATE_PATH not in _schema_ready:
+            _create_schema(conn)
+            _schema_ready.add(SHARED_STATE_PATH)
+
+    state = {"path": SHARED_STATE_PATH, "conn": conn, "tokens": {}, "data_version": None}
+    _local.state = state
+    return state
+
+
+def _create_schema(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS job_progress (
+        job_id TEXT PRIMARY KEY,
+        user_id INTEGER,
+        total INTEGER,
+        sent INTEGER DEFAULT 0,
+        failed INTEGER DEFAULT 0,
+        status TEXT,
+        error TEXT,
+        updated_at REAL
+    )
+    """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS access_tokens (
+        account_id INTEGER PRIMARY KEY,
+        access_token TEXT,
+        updated_at REAL
+    )
+    """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS rate_buckets (
+        key TEXT PRIMARY KEY,
+        tokens REAL,
+        updated_at REAL
+    )
+    """)
+
+
+# ===== JOB PROGRESS =====
+
+def start_job(job_id, user_id, total=None):
+    """Register a send job so any worker can report its progress"""
+    _connect()["conn"].execute("""
+        INSERT OR REPLACE INTO job_progress (job_id, user_id, total, sent, failed, status, updated_at)
+        VALUES (?, ?, ?, 0, 0, 'running', ?)
+    """, (job_id, user_id, total, time.time()))
+
+
+def set_job_total(job_id, total):
+    _connect()["conn"].execute(
+        "UPDATE job_progress SET total=?, updated_at=? WHERE job_id=?", (total, time.time(), job_id)
+    )
+
+
+def add_job_progress(job_id, sent=0, failed=0):
+    _connect()["conn"].execute("""
+        UPDATE job_progress SET sent=sent+?, failed=failed+?, updated_at=?
+        WHERE job_id=?
+    """, (sent, failed, time.time(), job_id))
+
+
+def finish_job(job_id, status="done", error=None):
+    _connect()["conn"].execute("""
+        UPDATE job_progress SET status=?, error=?, updated_at=? WHERE job_id=?
+    """, (status, error, time.time(), job_id))
+
+
+def reopen_job(job_id, redriven):
+    """Move redriven recipients from failed back to in progress"""
+    _connect()["conn"].execute("""
+        UPDATE job_progress SET failed=failed-?, status='running', error=NULL, updated_at=?
+        WHERE job_id=?
+    """, (redriven, time.time(), job_id))
+
+
+def get_job(job_id, user_id):
+    """Progress dict for a job owned by user_id, or None"""
+    row = _connect()["conn"].execute("""
+        SELECT job_id, total, sent, failed, status, error, updated_at
+        FROM job_progress WHERE job_id=? AND user_id=?
+    """, (job_id, user_id)).fetchone()
+    if not row:
+        return None
+    return {
+        "jobId": row[0],
+        "total": row[1],
+        "sent": row[2],
+        "failed": row[3],
+        "status": row[4],
+        "error": row[5],
+        "updatedAt": row[6],
+    }
+
+
+class JobProgress:
+    """Counts sends locally and flushes them to shared state at most once per interval"""
+
+    def __init__(self, job_id, interval=PROGRESS_FLUSH_INTERVAL):
+        self.job_id = job_id
+        self.interval = interval
+        self.sent = 0
+        self.failed = 0
+        self.flushed_at = time.monotonic()
+
+    def record(self, success):
+        if success:
+            self.sent += 1
+        else:
+            self.failed += 1
+        if time.monotonic() - self.flushed_at >= self.interval:
+            self.flush()
+
+    def flush(self):
+        if self.sent or self.failed:
+            add_job_progress(self.job_id, self.sent, self.failed)
+            self.sent = self.failed = 0
+        self.flushed_at = time.monotonic()
+
+
+# ===== ACCESS TOKENS =====
+
+def _token_cache():
+    """This thread's token cache, dropped whenever another connection wrote the file"""
+    state = _connect()
+    # data_version only changes when a different connection commits, so
+    # checking it is a cheap way to invalidate local copies
+    version = state["conn"].execute("PRAGMA data_version").fetchone()[0]
+    if version != state["data_version"]:
+        state["tokens"].clear()
+        state["data_version"] = version
+    return state["tokens"]
+
+
+def get_access_token(account_id):
+    """Latest access token any worker refreshed for an account, or None"""
+    cache = _token_cache()
+    if account_id not in cache:
+        row = _connect()["conn"].execute(
+            "SELECT access_token FROM access_tokens WHERE account_id=?", (account_id,)
+        ).fetchone()
+        cache[account_id] = decrypt_token(row[0]) if row else None
+    return cache[account_id]
+
+
+def put_access_token(account_id, access_token):
+    """Publish a refreshed access token to every worker"""
+    _connect()["conn"].execute("""
+        INSERT OR REPLACE INTO access_tokens (account_id, access_token, updated_at)
+        VALUES (?, ?, ?)
+    """, (account_id, encrypt_token(access_token), time.time()))
+    _token_cache()[account_id] = access_token
+
+
+# ===== RATE LIMITING =====
+
+def try_acquire(key, rate, capacity, cost=1.0):
+    """
+    Take cost tokens from a shared token bucket refilled at rate per second.
+    Returns 0 when granted, otherwise the seconds to wait before retrying.
+    """
+    conn = _connect()["conn"]
+    now = time.time()
+    # IMMEDIATE takes the write lock up front, so workers can't both spend
+    # the same tokens
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute(
+            "SELECT tokens, updated_at FROM rate_buckets WHERE key=?", (key,)
+        ).fetchone()
+        tokens = capacity if row is None else min(capacity, row[0] + (now - row[1]) * rate)
+        if tokens >= cost:
+            tokens -= cost
+            wait = 0.0
+        else:
+            wait = (cost - tokens) / rate
+        conn.execute(
+            "INSERT OR REPLACE INTO rate_buckets (key, tokens, updated_at) VALUES (?, ?, ?)",
+            (key, tokens, now),
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return wait
+
+
+def acquire(key, rate, capacity, cost=1.0):
+    """Block until cost tokens are available in the shared bucket"""
+    while True:
+        wait = try_acquire(key, rate, capacity, cost)
+        if not wait:
+            return
+        time.sleep(wait)
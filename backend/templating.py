@@ -0,0 +1,210 @@
+"""Email template compilation, HTML sanitising and the compiled-template cache"""
+import hashlib
+import html
+import re
+import threading
+from collections import OrderedDict
+from html.parser import HTMLParser
+from string import Formatter
+
+TEMPLATE_CACHE_SIZE = 128
+
+# Elements dropped together with their content
+_UNSAFE_ELEMENTS = {"script", "style", "iframe", "object", "embed", "form", "head", "title"}
+_VOID_ELEMENTS = {"br", "hr", "img", "meta", "link", "input", "col", "area", "base", "wbr"}
+_BLOCK_ELEMENTS = {"p", "div", "tr", "table", "ul", "ol", "h1", "h2", "h3", "h4", "h5", "h6", "blockquote"}
+
+
+class _Sanitizer(HTMLParser):
+    """Rebuilds HTML without scripts, event handlers or javascript: URLs"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.out = []
+        self.skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in _UNSAFE_ELEMENTS:
+            if tag not in _VOID_ELEMENTS:
+                self.skip_depth += 1
+            return
+        if self.skip_depth:
+            return
+        self.out.append(f"<{tag}{self._attrs(attrs)}>")
+
+    def handle_startendtag(self, tag, attrs):
+        if tag in _UNSAFE_ELEMENTS or self.skip_depth:
+            return
+        self.out.append(f"<{tag}{self._attrs(attrs)} />")
+
+    def handle_endtag(self, tag):
+        if tag in _UNSAFE_ELEMENTS:
+            self.skip_depth = max(0, self.skip_depth - 1)
+            return
+        if self.skip_depth or tag in _VOID_ELEMENTS:
+            return
+        self.out.append(f"</{tag}>")
+
+    def handle_data(self, data):
+        if not self.skip_depth:
+            self.out.append(data)
+
+    def handle_entityref(self, name):
+        if not self.skip_depth:
+            self.out.append(f"&{name};")
+
+    def handle_charref(self, name):
+        if not self.skip_depth:
+            self.out.append(f"&#{name};")
+
+    @staticmethod
+    def _attrs(attrs):
+        safe = []
+        for name, value in attrs:
+            if name.startswith("on"):
+                continue
+            if value is None:
+                safe.append(f" {name}")
+                continue
+            if name in ("href", "src") and value.strip().lower().startswith(("javascript:", "vbscript:", "data:text")):
+                continue
+            safe.append(f' {name}="{html.escape(value, quote=True)}"')
+        return "".join(safe)
+
+
+class _TextExtractor(HTMLParser):
+    """Produces the plain-text alternative of an HTML body"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.out = []
+        self.href = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "br":
+            self.out.append("\n")
+        elif tag == "li":
+            self.out.append("\n- ")
+        elif tag == "a":
+            self.href = dict(attrs).get("href")
+
+    def handle_endtag(self, tag):
+        if tag in _BLOCK_ELEMENTS:
+            self.out.append("\n\n")
+        elif tag == "a" and self.href:
+            self.out.append(f" ({self.href})")
+            self.href = None
+
+    def handle_data(self, data):
+        self.out.append(re.sub(r"\s+", " ", data))
+
+    def text(self):
+        lines = [line.strip() for line in "".join(self.out).splitlines()]
+        text = "\n".join(lines)
+        while "\n\n\n" in text:
+            text = text.replace("\n\n\n", "\n\n")
+        return text.strip()
+
+
+def sanitize_html(source):
+    """Strip scripts, event handlers and javascript: links from HTML"""
+    parser = _Sanitizer()
+    parser.feed(source)
+    parser.close()
+    return "".join(parser.out)
+
+
+def html_to_text(source):
+    """Generate a readable plain-text version of an HTML body"""
+    parser = _TextExtractor()
+    parser.feed(source)
+    parser.close()
+    return parser.text()
+
+
+def _compile(source):
+    """Split a str.format-style template into (literal, field, spec, conversion) segments"""
+    return tuple(Formatter().parse(source))
+
+
+def _render(segments, fields, escape=False):
+    out = []
+    for literal, field_name, format_spec, conversion in segments:
+        out.append(literal)
+        if field_name is None:
+            continue
+        value = fields[field_name]
+        if conversion == "r":
+            value = repr(value)
+        elif conversion == "s":
+            value = str(value)
+        value = format(value, format_spec or "")
+        out.append(html.escape(value) if escape else value)
+    return "".join(out)
+
+
+class CompiledTemplate:
+    """A parsed (and for HTML, sanitised) subject/body pair ready for rendering"""
+    __slots__ = ("subject", "text", "html")
+
+    def __init__(self, subject, body, is_html=False):
+        self.subject = _compile(subject)
+        if is_html:
+            clean = sanitize_html(body)
+            self.html = _compile(clean)
+            self.text = _compile(html_to_text(clean))
+        else:
+            self.html = None
+            self.text = _compile(body)
+
+    def render(self, fields):
+        """Return (subject, text_body, html_body or None) for one recipient"""
+        return (
+            _render(self.subject, fields),
+            _render(self.text, fields),
+            _render(self.html, fields, escape=True) if self.html is not None else None,
+        )
+
+
+class LRUCache:
+    """Small thread-safe least-recently-used cache"""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+
+_compiled_cache = LRUCache(TEMPLATE_CACHE_SIZE)
+
+
+def template_hash(subject, body, is_html=False):
+    """Content hash used to key compiled templates"""
+    digest = hashlib.sha256()
+    for part in (subject, "\0", body, "\0", "html" if is_html else "text"):
+        digest.update(part.encode("utf-8"))
+    return digest.hexdigest()
+
+
+def get_compiled(subject, body, is_html=False):
+    """Return a compiled template, reusing a cached one with the same content"""
+    key = template_hash(subject, body, is_html)
+    compiled = _compiled_cache.get(key)
+    if compiled is None:
+        compiled = CompiledTemplate(subject, body, is_html)
+        _compiled_cache.put(key, compiled)
+    return compiled
@@ -0,0 +1,23 @@
+"""
+Test setup: the backend is a set of flat modules, and db.py/shared_state.py
+open their databases on import, so both are pointed at a throwaway directory
+before any test module imports them.
+Run from backend/ with: python -m pytest tests
+"""
+import os
+import sys
+import tempfile
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+_data_dir = tempfile.mkdtemp(prefix="coldmail-tests-")
+os.environ["DATABASE_PATH"] = os.path.join(_data_dir, "database.db")
+os.environ["SHARED_STATE_PATH"] = os.path.join(_data_dir, "shared_state.db")
+os.environ.setdefault("GOOGLE_CLIENT_ID", "test-client-id")
+os.environ.setdefault("GOOGLE_CLIENT_SECRET", "test-client-secret")
+os.environ.setdefault("SESSION_SECRET", "test-session-secret")
+
+import migrations  # noqa: E402
+
+migrations.migrate()
@@ -0,0 +1,23 @@
+"""Appending to a stored CSV keeps it readable through every path"""
+import db
+from csv_store import csv_text
+
+
+def test_appended_csv_reads_back():
+    user_id = db.get_or_create_user("append-google-id", "append@example.com", "Append")
+    # No trailing newline: the appended rows must still start on their own line
+    csv_id = db.save_csv(user_id, "append.csv", "name,email\nA,a@example.com")
+
+    assert db.append_csv(csv_id, user_id, "name,email\nA,a@example.com\nB,b@example.com\n") == 1
+    assert db.append_csv(csv_id, user_id, "name,email\nC,c@example.com\n") == 1
+
+    expected = "name,email\nA,a@example.com\nB,b@example.com\nC,c@example.com\n"
+    content, content_gz, kind = db.conn.execute(
+        "SELECT content, content_gz, typeof(content_gz) FROM csvs WHERE id=?", (csv_id,)
+    ).fetchone()
+    assert kind == "blob"
+    assert csv_text(content, content_gz) == expected
+    assert b"".join(db.iter_csv_content(csv_id)).decode("utf-8") == expected
+    assert db.get_csv_rows(csv_id) == [
+        (0, ["A", "a@example.com"]), (1, ["B", "b@example.com"]), (2, ["C", "c@example.com"]),
+    ]
@@ -0,0 +1,60 @@
+"""A domain's max_concurrent holds across batches sending at the same time (sender slices)"""
+import threading
+import time
+
+import dispatcher
+import domains
+import gmail_mailer
+from recipients import Recipient
+
+BATCHES = 4
+MAX_CONCURRENT = 2
+
+
+def peak_concurrent_sends(monkeypatch, shared_slots):
+    """Most sends to one domain in flight at once while BATCHES batches run side by side"""
+    monkeypatch.setattr(dispatcher, "ACCOUNT_DAILY_LIMIT", 10 ** 9)
+    monkeypatch.setattr(domains, "DOMAIN_SENDS_PER_MINUTE", 10 ** 9)
+    monkeypatch.setattr(domains, "DOMAIN_SEND_BURST", 10 ** 9)
+    monkeypatch.setattr(domains, "DOMAIN_MAX_CONCURRENT", MAX_CONCURRENT)
+
+    lock = threading.Lock()
+    in_flight = [0]
+    peak = [0]
+
+    def send(self, raw_message):
+        with lock:
+            in_flight[0] += 1
+            peak[0] = max(peak[0], in_flight[0])
+        time.sleep(0.01)
+        with lock:
+            in_flight[0] -= 1
+        return {"id": "m", "threadId": "t"}
+
+    monkeypatch.setattr(gmail_mailer.SenderAccount, "send", send)
+
+    slots = domains.DomainSlots() if shared_slots else None
+
+    def batch(n):
+        recipients = [Recipient(i, f"user{n}-{i}@example.com", ("email",), (f"user{n}-{i}@example.com",))
+                      for i in range(20)]
+        gmail_mailer.send_batch_via_gmail(
+            [(n, f"sender{n}@example.com", "Sender", "token", None)], recipients, "Hello", "Hi",
+            domain_slots=slots,
+        )
+
+    threads = [threading.Thread(target=batch, args=(n,)) for n in range(BATCHES)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return peak[0]
+
+
+def test_batches_sharing_slots_respect_domain_concurrency(monkeypatch):
+    assert peak_concurrent_sends(monkeypatch, shared_slots=True) <= MAX_CONCURRENT
+
+
+def test_separate_batches_would_each_take_the_full_limit(monkeypatch):
+    # Why the sender shares one DomainSlots between its slices
+    assert peak_concurrent_sends(monkeypatch, shared_slots=False) > MAX_CONCURRENT
@@ -0,0 +1,110 @@
+"""
+Simulations of the sender's fair-share scheduling: tenants with queued
+recipients share a fixed number of slots, and each slice sends up to its
+budget before handing its slot back.
+"""
+from collections import deque
+
+from fair_share import FairShareScheduler
+
+QUANTUM = 10
+
+
+class Simulation:
+    """The sender's main loop without threads: slices finish in the order they started"""
+
+    def __init__(self, slots, quantum=QUANTUM):
+        self.scheduler = FairShareScheduler(quantum)
+        self.slots = slots
+        # user_id -> [job_id, pending recipients, weight, max_slices]
+        self.tenants = {}
+        self.running = deque()
+        self.picks = []
+        self.sent = {}
+        self.peak_slices = {}
+
+    def add(self, user_id, job_id, recipients, weight=1, max_slices=1):
+        self.tenants[user_id] = [job_id, recipients, weight, max_slices]
+
+    def runnable(self):
+        return [(job_id, user_id, weight, max_slices)
+                for user_id, (job_id, pending, weight, max_slices) in self.tenants.items()
+                if pending > 0]
+
+    def fill(self):
+        """Start slices until the slots are full or nobody may run"""
+        while len(self.running) < self.slots:
+            picked = self.scheduler.pick(self.runnable())
+            if not picked:
+                return
+            job_id, user_id, budget, seconds = picked
+            self.picks.append((user_id, budget))
+            # A slice claims its recipients up front, so two slices of the
+            # same tenant never send the same ones
+            used = min(budget, self.tenants[user_id][1])
+            self.tenants[user_id][1] -= used
+            self.running.append((user_id, budget, used))
+            slices = sum(1 for running in self.running if running[0] == user_id)
+            self.peak_slices[user_id] = max(self.peak_slices.get(user_id, 0), slices)
+
+    def finish_one(self):
+        user_id, budget, used = self.running.popleft()
+        self.sent[user_id] = self.sent.get(user_id, 0) + used
+        self.scheduler.finished(user_id, budget, used, self.tenants[user_id][2])
+
+    def step(self):
+        self.fill()
+        self.finish_one()
+
+
+def test_small_tenant_gets_a_slice_within_one_pick():
+    sim = Simulation(slots=2)
+    sim.add("large", 1, 100_000, max_slices=2)
+    sim.fill()
+    assert [user for user, _ in sim.picks] == ["large", "large"]
+
+    sim.add("small", 2, 5)
+    sim.finish_one()
+    sim.fill()
+    # The first slot to free up goes to the newcomer, not the big backlog
+    assert sim.picks[2] == ("small", QUANTUM)
+
+    while sim.running:
+        sim.finish_one()
+    assert sim.sent["small"] == 5
+
+
+def test_tenant_cap_limits_concurrent_slices():
+    sim = Simulation(slots=4)
+    sim.add("large", 1, 100_000, max_slices=1)
+    sim.add("capped_at_two", 2, 100_000, max_slices=2)
+    for _ in range(50):
+        sim.step()
+    assert sim.peak_slices == {"large": 1, "capped_at_two": 2}
+
+    # Nobody else has work, so the free slots stay empty rather than exceed the caps
+    sim.fill()
+    assert len(sim.running) == 3
+
+
+def test_weights_split_sends_proportionally():
+    sim = Simulation(slots=1)
+    sim.add("heavy", 1, 100_000, weight=3)
+    sim.add("light", 2, 100_000, weight=1)
+    for _ in range(200):
+        sim.step()
+
+    assert {user: budget for user, budget in sim.picks[:2]} == {"heavy": 3 * QUANTUM, "light": QUANTUM}
+    assert sim.sent["heavy"] == 3 * sim.sent["light"]
+
+
+def test_unused_budget_carries_over_up_to_one_quantum():
+    scheduler = FairShareScheduler(QUANTUM)
+    jobs = [(1, "user", 1, 1)]
+
+    _, _, budget, _ = scheduler.pick(jobs)
+    scheduler.finished("user", budget, used=4)
+    assert scheduler.pick(jobs)[2] == QUANTUM + 6
+
+    scheduler.finished("user", QUANTUM + 6, used=0)
+    assert scheduler.pick(jobs)[2] == 2 * QUANTUM
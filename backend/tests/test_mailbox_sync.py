@@ -0,0 +1,155 @@
+"""Reply and bounce sync against a local fake of Gmail's history, messages and profile endpoints"""
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+import db
+import gmail_mailer
+import mailbox_sync
+
+
+class FakeGmail:
+    """Mailbox state served by the handler below"""
+
+    def __init__(self):
+        self.history_id = "100"
+        # startHistoryId -> pages of history records; a missing id is "expired" (404)
+        self.history = {}
+        self.messages = {}
+        self.fetched = []
+
+
+def handler_for(gmail):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = {key: values[0] for key, values in parse_qs(url.query).items()}
+            path = url.path.rstrip("/").split("/")
+            if path[-1] == "profile":
+                return self.reply(200, {"emailAddress": "sender@example.com", "historyId": gmail.history_id})
+            if path[-1] == "history":
+                pages = gmail.history.get(query["startHistoryId"])
+                if pages is None:
+                    return self.reply(404, {"error": {"code": 404, "message": "Requested entity was not found."}})
+                page = int(query.get("pageToken", 0))
+                response = {"history": pages[page], "historyId": gmail.history_id}
+                if page + 1 < len(pages):
+                    response["nextPageToken"] = str(page + 1)
+                return self.reply(200, response)
+            if path[-2] == "messages":
+                gmail.fetched.append(path[-1])
+                return self.reply(200, gmail.messages[path[-1]])
+            self.reply(404, {"error": {"code": 404, "message": "Not found"}})
+
+        def reply(self, status, body):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+@pytest.fixture
+def gmail(monkeypatch):
+    fake = FakeGmail()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler_for(fake))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(gmail_mailer, "GMAIL_API_ROOT", f"http://127.0.0.1:{server.server_port}/")
+    yield fake
+    server.shutdown()
+    server.server_close()
+
+
+def added(message_id, thread_id, *labels):
+    return {"messagesAdded": [{"message": {"id": message_id, "threadId": thread_id, "labelIds": list(labels)}}]}
+
+
+def metadata(message_id, thread_id, **headers):
+    return {
+        "id": message_id,
+        "threadId": thread_id,
+        "payload": {"headers": [{"name": name.replace("_", "-"), "value": value} for name, value in headers.items()]},
+    }
+
+
+def sent_events(job_id):
+    return {
+        email: (replied is not None, bounced is not None)
+        for email, replied, bounced in db.conn.execute(
+            "SELECT recipient_email, replied_at, bounced_at FROM emails_sent WHERE job_id=?", (job_id,)
+        )
+    }
+
+
+def sync_row(account_id):
+    return next(row for row in db.get_sync_accounts() if row[0] == account_id)
+
+
+def test_sync_records_replies_and_bounces(gmail):
+    user_id = db.get_or_create_user("sync-google-id", "sync@example.com", "Sync")
+    account_id = db.add_gmail_account(user_id, "sync-gmail", "sender@example.com", "Sender", "token", "refresh")
+    csv_id = db.save_csv(user_id, "sync.csv", "email\nann@example.com\nbob@example.com\ncat@example.com\n")
+    db.create_send_job("sync-job", user_id, csv_id, 0, "Hello", "Hi", False, [account_id], [])
+    for row_index, email in enumerate(["ann@example.com", "bob@example.com", "cat@example.com"]):
+        db.record_sent_item("sync-job", user_id, "Hello", row_index, email, account_id, f"sent-{row_index}", f"thread-{row_index}")
+
+    # First sync only starts tracking from the mailbox's current history id
+    assert mailbox_sync.sync_account(sync_row(account_id)) == 0
+    assert sync_row(account_id)[6] == "100"
+
+    gmail.history_id = "150"
+    gmail.history["100"] = [
+        [
+            added("reply-1", "thread-0", "INBOX"),
+            # The account's own follow-up in the same thread isn't a reply
+            added("own-1", "thread-0", "SENT"),
+        ],
+        [
+            # A bounce lands in bob's thread but names cat as the failed recipient
+            added("bounce-1", "thread-1", "INBOX"),
+            added("unrelated-1", "thread-other", "INBOX"),
+        ],
+    ]
+    gmail.messages["reply-1"] = metadata("reply-1", "thread-0", From="Ann <ann@example.com>")
+    gmail.messages["bounce-1"] = metadata(
+        "bounce-1", "thread-1", From="Mail Delivery Subsystem <mailer-daemon@googlemail.com>",
+        X_Failed_Recipients="cat@example.com",
+    )
+
+    assert mailbox_sync.sync_account(sync_row(account_id)) == 2
+    assert sent_events("sync-job") == {
+        "ann@example.com": (True, False),
+        "bob@example.com": (False, False),
+        "cat@example.com": (False, True),
+    }
+    assert db.get_send_job("sync-job")[13:15] == (1, 1)
+    # Only messages in campaign threads are fetched
+    assert sorted(gmail.fetched) == ["bounce-1", "reply-1"]
+    assert sync_row(account_id)[6] == "150"
+
+    # Already recorded events aren't counted twice
+    gmail.history["150"] = [[added("reply-2", "thread-0", "INBOX")]]
+    gmail.messages["reply-2"] = metadata("reply-2", "thread-0", From="ann@example.com")
+    assert mailbox_sync.sync_account(sync_row(account_id)) == 0
+    assert db.get_send_job("sync-job")[13:15] == (1, 1)
+
+
+def test_expired_history_resets_the_history_id(gmail):
+    user_id = db.get_or_create_user("expired-google-id", "expired@example.com", "Expired")
+    account_id = db.add_gmail_account(user_id, "expired-gmail", "old@example.com", "Old", "token", "refresh")
+    db.set_history_id(account_id, "5")
+
+    # Gmail answers 404 for a history id it no longer keeps
+    gmail.history_id = "900"
+    assert mailbox_sync.sync_account(sync_row(account_id)) == 0
+    assert sync_row(account_id)[6] == "900"
+    assert gmail.fetched == []
@@ -0,0 +1,68 @@
+"""
+Cheap requests stay fast while an upload is writing a large CSV to the database.
+"""
+import threading
+import time
+
+from fastapi.testclient import TestClient
+
+import db
+from main import app
+
+UPLOAD_ROWS = 200_000
+# Both probes are a few indexed lookups; anything near this means they waited on the upload
+MAX_REQUEST_SECONDS = 0.25
+
+
+def test_requests_are_not_blocked_by_an_upload():
+    user_id = db.get_or_create_user("latency-google-id", "latency@example.com", "Latency")
+    session_id = db.create_session(user_id, {"id": user_id, "email": "latency@example.com", "name": "Latency"})
+    cookies = {"session_id": session_id}
+    small_csv_id = db.save_csv(user_id, "small.csv", "name,email\n" + "".join(
+        f"Person {i},person{i}@example.com\n" for i in range(50)))
+    content = "name,email\n" + "".join(f"Person {i},person{i}@example.com\n" for i in range(UPLOAD_ROWS))
+
+    uploaded = {}
+
+    def upload():
+        client = TestClient(app, cookies=cookies)
+        started = time.perf_counter()
+        response = client.post("/upload-csv", files={"file": ("big.csv", content, "text/csv")})
+        uploaded["seconds"] = time.perf_counter() - started
+        uploaded["response"] = response
+
+    client = TestClient(app, cookies=cookies)
+    assert client.get("/auth/me").json()["authenticated"]
+
+    def auth_me(i):
+        # A sync handler, run in Starlette's threadpool
+        assert client.get("/auth/me").json()["email"] == "latency@example.com"
+
+    def preview(i):
+        # An async handler: every query goes through async_db, like the upload's.
+        # The subject changes every time, so the preview cache never answers
+        response = client.post(f"/csvs/{small_csv_id}/preview", json={
+            "rowIndex": i % 50, "template": {"subject": f"Probe {i}", "body": "Hi"},
+        })
+        assert response.json()["subject"] == f"Probe {i}"
+
+    thread = threading.Thread(target=upload)
+    thread.start()
+    latencies = {auth_me: [], preview: []}
+    i = 0
+    while thread.is_alive():
+        for probe, seconds in latencies.items():
+            started = time.perf_counter()
+            probe(i)
+            seconds.append(time.perf_counter() - started)
+        i += 1
+    thread.join()
+
+    assert uploaded["response"].status_code == 200
+    assert not uploaded["response"].json()["deduplicated"]
+    # The upload was slow enough to overlap many requests...
+    assert uploaded["seconds"] > 10 * MAX_REQUEST_SECONDS
+    for probe, seconds in latencies.items():
+        assert len(seconds) >= 5
+        # ...and none of them waited for it
+        assert max(seconds) < MAX_REQUEST_SECONDS, f"slowest {probe.__name__} took {max(seconds):.3f}s"
@@ -0,0 +1,52 @@
+"""Peak memory of the send pipeline must not grow with the size of the list"""
+import tracemalloc
+
+import dispatcher
+import domains
+import gmail_mailer
+from recipients import Recipient, read_csv
+
+
+def csv_content(rows):
+    return "email,name,company\n" + "".join(
+        f"user{i}@domain{i % 40}.com,Name {i},\"Company {i}\nLtd\"\n" for i in range(rows)
+    )
+
+
+def peak_send_memory(content, monkeypatch):
+    """Bytes allocated at peak while every row is read, rendered, encoded and 'sent'"""
+    monkeypatch.setattr(gmail_mailer.SenderAccount, "send", lambda self, raw: {"id": "m", "threadId": "t"})
+    monkeypatch.setattr(dispatcher, "ACCOUNT_DAILY_LIMIT", 10 ** 9)
+    monkeypatch.setattr(domains, "DOMAIN_SENDS_PER_MINUTE", 10 ** 9)
+    monkeypatch.setattr(domains, "DOMAIN_MAX_CONCURRENT", 10 ** 6)
+    monkeypatch.setattr(domains, "DOMAIN_SEND_BURST", 10 ** 9)
+    sent = []
+
+    tracemalloc.start()
+    try:
+        headers, rows = read_csv(content)
+        recipients = (Recipient(i, values[0], headers, tuple(values)) for i, values in rows)
+        gmail_mailer.send_batch_via_gmail(
+            [(1, "sender@example.com", "Sender", "token", None)],
+            recipients,
+            "Hello {name}",
+            "Hi {name} at {company}",
+            on_sent=lambda recipient, account_id, response: sent.append(None),
+        )
+        return tracemalloc.get_traced_memory()[1], len(sent)
+    finally:
+        tracemalloc.stop()
+
+
+def test_peak_memory_is_flat_in_list_size(monkeypatch):
+    small = csv_content(1000)
+    large = csv_content(10000)
+
+    small_peak, small_sent = peak_send_memory(small, monkeypatch)
+    large_peak, large_sent = peak_send_memory(large, monkeypatch)
+
+    assert (small_sent, large_sent) == (1000, 10000)
+    # 10x the rows, but the peak stays within noise of the small list; what
+    # remains is the fixed cost of the pool and the domain lookahead
+    assert large_peak < small_peak * 1.5
+    assert large_peak < 1024 * 1024
@@ -0,0 +1,59 @@
+"""A job's attachments are read and encoded once, however many slices it runs in"""
+import base64
+import email
+
+import db
+import dispatcher
+import domains
+import gmail_mailer
+import sender
+
+RECIPIENTS = 12
+SLICE_BUDGET = 5
+
+
+def test_attachments_are_encoded_once_per_job(monkeypatch):
+    monkeypatch.setattr(dispatcher, "ACCOUNT_DAILY_LIMIT", 10 ** 9)
+    monkeypatch.setattr(domains, "DOMAIN_SENDS_PER_MINUTE", 10 ** 9)
+    monkeypatch.setattr(domains, "DOMAIN_SEND_BURST", 10 ** 9)
+    sends = []
+    monkeypatch.setattr(gmail_mailer.SenderAccount, "send",
+                        lambda self, raw: sends.append(raw) or {"id": f"m{len(sends)}", "threadId": "t"})
+    blob_reads = []
+    monkeypatch.setattr(sender, "get_attachment_blob", lambda sha256: blob_reads.append(sha256) or db.get_attachment_blob(sha256))
+    encodes = []
+    real_tail = gmail_mailer.MessageBuilder._attachment_tail
+    monkeypatch.setattr(gmail_mailer.MessageBuilder, "_attachment_tail",
+                        lambda self, attachments: encodes.append(1) or real_tail(self, attachments))
+
+    user_id = db.get_or_create_user("attach-google-id", "attach@example.com", "Attach")
+    account_id = db.add_gmail_account(user_id, "attach-gmail", "sender@example.com", "Sender", "token", "refresh")
+    attachment_id = db.save_attachment(user_id, "brochure.pdf", "application/pdf", b"%PDF-1.4 brochure")
+    csv_id = db.save_csv(user_id, "attach.csv", "email\n" + "".join(
+        f"user{i}@domain{i}.com\n" for i in range(RECIPIENTS)))
+    db.create_send_job("attach-job", user_id, csv_id, 0, "Hello", "Hi", False, [account_id], [attachment_id])
+
+    slices = 0
+    while db.get_send_job("attach-job")[8] != "done":
+        sender.run_job(db.get_send_job("attach-job"), budget=SLICE_BUDGET)
+        slices += 1
+
+    assert slices == 3
+    assert len(sends) == RECIPIENTS
+    assert len(blob_reads) == 1
+    assert len(encodes) == 1
+    for raw in sends:
+        message = email.message_from_bytes(base64.urlsafe_b64decode(raw))
+        files = [(part.get_filename(), part.get_payload(decode=True))
+                 for part in message.walk() if part.get_filename()]
+        assert files == [("brochure.pdf", b"%PDF-1.4 brochure")]
+
+
+def test_job_with_a_missing_attachment_fails():
+    user_id = db.get_or_create_user("missing-google-id", "missing@example.com", "Missing")
+    account_id = db.add_gmail_account(user_id, "missing-gmail", "sender@example.com", "Sender", "token", "refresh")
+    csv_id = db.save_csv(user_id, "missing.csv", "email\nuser@example.com\n")
+    db.create_send_job("missing-job", user_id, csv_id, 0, "Hello", "Hi", False, [account_id], [987654])
+
+    assert sender.run_job(db.get_send_job("missing-job")) == 0
+    assert db.get_send_job("missing-job")[8] == "failed"
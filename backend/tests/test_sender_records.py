@@ -0,0 +1,65 @@
+"""A recipient Gmail accepted is never sent again, even if recording it fails"""
+import sqlite3
+import threading
+import time
+
+import pytest
+
+import db
+import dispatcher
+import domains
+import gmail_mailer
+import sender
+
+RECIPIENTS = 30
+
+
+def test_sends_that_fail_to_record_are_kept_not_resent(monkeypatch):
+    monkeypatch.setattr(dispatcher, "ACCOUNT_DAILY_LIMIT", 10 ** 9)
+    monkeypatch.setattr(domains, "DOMAIN_SENDS_PER_MINUTE", 10 ** 9)
+    monkeypatch.setattr(domains, "DOMAIN_SEND_BURST", 10 ** 9)
+
+    sends = []
+    lock = threading.Lock()
+
+    def send(self, raw_message):
+        # Slow enough that all 8 concurrent sends are in flight when a record fails
+        time.sleep(0.02)
+        with lock:
+            sends.append(raw_message)
+            return {"id": f"m{len(sends)}", "threadId": "t"}
+
+    monkeypatch.setattr(gmail_mailer.SenderAccount, "send", send)
+
+    records = []
+
+    def flaky_record(*args):
+        records.append(args)
+        # The second failure comes from the drain after the first one aborted the batch
+        if len(records) in (5, 6):
+            raise sqlite3.OperationalError("database is locked")
+        return db.record_sent_item(*args)
+
+    monkeypatch.setattr(sender, "record_sent_item", flaky_record)
+
+    user_id = db.get_or_create_user("records-google-id", "records@example.com", "Records")
+    account_id = db.add_gmail_account(user_id, "records-gmail", "sender@example.com", "Sender", "token", "refresh")
+    csv_id = db.save_csv(user_id, "records.csv", "email\n" + "".join(
+        f"user{i}@domain{i}.com\n" for i in range(RECIPIENTS)))
+    db.create_send_job("records-job", user_id, csv_id, 0, "Hello", "Hi", False, [account_id], [])
+
+    with pytest.raises(sqlite3.OperationalError):
+        sender.run_job(db.get_send_job("records-job"))
+    recorded = db.get_send_job("records-job")[10]
+    assert len(sends) > 6
+    # Every message Gmail accepted is either recorded or kept to record
+    assert recorded + len(sender.unrecorded["records-job"]) == len(sends)
+
+    sender.run_job(db.get_send_job("records-job"))
+    assert "records-job" not in sender.unrecorded
+    assert len(sends) == RECIPIENTS
+    assert db.get_send_job("records-job")[8:11] == ("done", RECIPIENTS, RECIPIENTS)
+    logged = db.conn.execute(
+        "SELECT COUNT(*), COUNT(DISTINCT recipient_email) FROM emails_sent WHERE job_id='records-job'"
+    ).fetchone()
+    assert logged == (RECIPIENTS, RECIPIENTS)
@@ -24,8 +24,10 @@ type Sender = {
 };
 
 type Template = {
+  templateId?: number;
   subject: string;
   body: string;
+  isHtml?: boolean;
 };
 
 export default function PreviewPage() {
@@ -122,13 +124,9 @@ export default function PreviewPage() {
       if (!csvId) throw new Error("Invalid CSV response");
 
       setProgress(40);
-      setProgressMessage("Sending emails via Gmail API...");
-
-      // Send emails using Gmail API with selected sender account IDs
-      // Increased timeout to 5 minutes (300000ms) to handle large batches
-      const controller = new AbortController();
-      const timeoutId = setTimeout(() => controller.abort(), 300000);
+      setProgressMessage("Queuing emails...");
 
+      // The server queues a send job and returns immediately
       const sendRes = await fetch(`${API}/send-emails`, {
         method: "POST",
         credentials: "include",
@@ -136,23 +134,42 @@ export default function PreviewPage() {
         body: JSON.stringify({
           csvId,
           senderAccountIds: senders, // Array of Gmail account IDs
+          templateId: template?.templateId,
           template,
         }),
-        signal: controller.signal,
       });
 
-      clearTimeout(timeoutId);
-
       if (!sendRes.ok) {
         const error = await sendRes.json();
         throw new Error(error.error || "Email sending failed");
       }
 
-      const sendJson = await sendRes.json();
+      const { jobId } = await sendRes.json();
+
+      // Poll job progress until the sender process finishes
+      let job = { status: "queued", total: 0, sent: 0, failed: 0, error: null };
+      while (job.status === "queued" || job.status === "running") {
+        await new Promise((resolve) => setTimeout(resolve, 2000));
+
+        const jobRes = await fetch(`${API}/send-jobs/${jobId}`, {
+          credentials: "include",
+        });
+        if (!jobRes.ok) continue;
+
+        job = await jobRes.json();
+        const done = job.sent + job.failed;
+        setProgress(job.total ? 40 + Math.round((done / job.total) * 60) : 40);
+        setProgressMessage(`Sending emails via Gmail API... ${done}/${job.total}`);
+      }
+
+      if (job.status !== "done") {
+        throw new Error(job.error || "Email sending failed");
+      }
+
       setProgress(100);
-      setProgressMessage(`${sendJson.emailsSent} emails sent successfully!`);
+      setProgressMessage(`${job.sent} emails sent successfully!`);
 
-      showToast(`Emails sent successfully (${sendJson.emailsSent} emails)`, "success");
+      showToast(`Emails sent successfully (${job.sent} emails)`, "success");
 
       localStorage.clear();
 
@@ -6,6 +6,8 @@ import { useState, useEffect } from "react";
 import { useRouter } from "next/navigation";
 import { showToast } from "@/src/components/Toast";
 
+const API = process.env.NEXT_PUBLIC_API_URL as string;
+
 type CSVData = {
   headers: string[];
   rows: string[][];
@@ -15,9 +17,12 @@ export default function TemplatePage() {
   const router = useRouter();
   const [csvData, setCSVData] = useState<CSVData | null>(null);
   const [template, setTemplate] = useState({
+    name: "",
     subject: "",
     body: "",
+    isHtml: false,
   });
+  const [saving, setSaving] = useState(false);
   const [preview, setPreview] = useState<{
     subject: string;
     body: string;
@@ -64,15 +69,35 @@ export default function TemplatePage() {
     }
   }, [template, previewRowIndex, csvData]);
 
-  const handleSave = () => {
+  const handleSave = async () => {
     if (!template.subject || !template.body) {
       showToast("Please fill subject and body", "error");
       return;
     }
 
-    localStorage.setItem("emailTemplate", JSON.stringify(template));
-    showToast("Template saved! Moving to preview...", "success");
-    router.push("/preview");
+    setSaving(true);
+    try {
+      // Templates are versioned server-side; saving the same name adds a version
+      const res = await fetch(`${API}/templates`, {
+        method: "POST",
+        credentials: "include",
+        headers: { "Content-Type": "application/json" },
+        body: JSON.stringify(template),
+      });
+
+      if (!res.ok) throw new Error("Failed to save template");
+
+      const saved = await res.json();
+      localStorage.setItem(
+        "emailTemplate",
+        JSON.stringify({ ...template, templateId: saved.id })
+      );
+      showToast(`Template saved (v${saved.version})! Moving to preview...`, "success");
+      router.push("/preview");
+    } catch (err: unknown) {
+      showToast(err instanceof Error ? err.message : "Failed to save template", "error");
+      setSaving(false);
+    }
   };
 
   return (
@@ -118,6 +143,22 @@ export default function TemplatePage() {
                   </div>
                 )}
 
+                {/* Name Input */}
+                <div className="mb-6">
+                  <label className="block text-sm font-semibold mb-2">
+                    Template Name
+                  </label>
+                  <input
+                    type="text"
+                    value={template.name}
+                    onChange={(e) =>
+                      setTemplate({ ...template, name: e.target.value })
+                    }
+                    placeholder="e.g., Intro outreach"
+                    className="w-full px-4 py-2 border rounded-lg focus:outline-none focus:ring-2 focus:ring-brand"
+                  />
+                </div>
+
                 {/* Subject Input */}
                 <div className="mb-6">
                   <label className="block text-sm font-semibold mb-2">
@@ -147,6 +188,16 @@ export default function TemplatePage() {
                     placeholder="Dear {name},&#10;&#10;I wanted to reach out to you at {company}..."
                     className="w-full px-4 py-3 border rounded-lg focus:outline-none focus:ring-2 focus:ring-brand h-64"
                   />
+                  <label className="flex items-center gap-2 mt-3 text-sm">
+                    <input
+                      type="checkbox"
+                      checked={template.isHtml}
+                      onChange={(e) =>
+                        setTemplate({ ...template, isHtml: e.target.checked })
+                      }
+                    />
+                    Send body as HTML (a plain-text version is generated automatically)
+                  </label>
                 </div>
               </div>
             </div>
@@ -210,6 +261,7 @@ export default function TemplatePage() {
             </button>
             <button
               onClick={handleSave}
+              disabled={saving}
               className="flex-1 bg-brand text-white px-8 py-3 rounded-lg font-semibold hover:bg-orange-600 transition"
             >
               Continue to Preview & Send →